@@ -0,0 +1,302 @@
+import argparse
+import fcntl
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import termios
+import threading
+import time
+
+from chanlog import parse_time, query
+from sendqueue import TokenBucket
+from tracing import Tracer
+
+DEFAULT_SOCKET = "irc-admin.sock"
+# An admin connection that sends nothing for this long is dropped, so it can't hold up the next one
+ADMIN_TIMEOUT = 30
+# Offset of tcpi_rtt (microseconds) in Linux's struct tcp_info: 8 one-byte fields, then 15 uint32s before it
+TCP_INFO_RTT = struct.Struct("=I")
+TCP_INFO_RTT_OFFSET = 68
+# Settings where 0 would stall the scheduler or drop every client, rather than mean "no limit"
+POSITIVE_TUNABLES = ("line_quota", "byte_quota", "max_pending", "delivery_quota", "sendq_limit")
+
+
+# Smoothed round trip time the kernel measured for a TCP socket, in milliseconds, or None if unavailable
+def tcp_rtt(sock):
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except (OSError, AttributeError, TypeError):
+        return None
+    if len(info) < TCP_INFO_RTT_OFFSET + TCP_INFO_RTT.size:
+        return None
+    return TCP_INFO_RTT.unpack_from(info, TCP_INFO_RTT_OFFSET)[0] / 1000
+
+
+# Bytes written to a socket that the peer hasn't acknowledged yet, i.e. its send queue depth
+def unsent_bytes(sock):
+    try:
+        return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+    except (OSError, AttributeError, TypeError, ValueError):
+        return None
+
+
+class AdminServer:
+    # Line based control socket for operators on the server host: one command per line, one JSON reply
+    # per line. It runs on its own thread and only touches client state through short snapshots, so a
+    # slow admin request never stalls client I/O.
+    def __init__(self, server, path=DEFAULT_SOCKET):
+        self.server = server
+        self.path = path
+        self.sock = None
+        self.commands = {
+            "help": self.cmd_help,
+            "clients": self.cmd_clients,
+            "channels": self.cmd_channels,
+            "kill": self.cmd_kill,
+            "throttle": self.cmd_throttle,
+            "loglevel": self.cmd_loglevel,
+            "get": self.cmd_get,
+            "set": self.cmd_set,
+            "log": self.cmd_log,
+            "trace": self.cmd_trace,
+        }
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        # Only the user running the server may connect
+        os.chmod(self.path, 0o600)
+        self.sock.listen(5)
+        thread = threading.Thread(target=self.serve, name="admin")
+        thread.daemon = True
+        thread.start()
+        logging.info(f"Admin socket listening on {self.path}")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def serve(self):
+        while self.sock is not None:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            try:
+                self.handle(conn)
+            except OSError as e:
+                logging.warning(f"Admin connection error: {e}")
+            finally:
+                conn.close()
+
+    def handle(self, conn):
+        conn.settimeout(ADMIN_TIMEOUT)
+        for line in conn.makefile("r", encoding="utf-8"):
+            line = line.strip()
+            if not line:
+                continue
+            conn.sendall((json.dumps(self.execute(line)) + "\n").encode("utf-8"))
+
+    # Run one command line and return the reply: {"ok": true, ...} or {"ok": false, "error": "..."}
+    def execute(self, line):
+        name, *args = line.split()
+        command = self.commands.get(name.lower())
+        if command is None:
+            return {"ok": False, "error": f"unknown command {name}, try help"}
+        try:
+            reply = command(*args)
+        except TypeError:
+            return {"ok": False, "error": f"wrong arguments for {name}, try help"}
+        except ValueError as e:
+            return {"ok": False, "error": str(e)}
+        reply.setdefault("ok", True)
+        return reply
+
+    # Copy of the client list, the only thing done while holding c_lock
+    def snapshot_clients(self):
+        with self.server.c_lock:
+            return list(self.server.clients)
+
+    def find_client(self, nickname):
+        client = self.server.presence.lookup(nickname)
+        if client is not None:
+            return client
+        # Not registered yet
+        for client in self.snapshot_clients():
+            if client.nickname == nickname:
+                return client
+        raise ValueError(f"no client {nickname}")
+
+    def cmd_help(self):
+        return {"commands": [
+            "clients",
+            "channels [name]",
+            "kill <nick> [reason]",
+            "throttle <nick> <lines per second> [burst] | throttle <nick> off",
+            "loglevel [DEBUG|INFO|WARNING|ERROR]",
+            "get [name]",
+            "set <name> <value>",
+            "log <channel> <start> <end> [limit]",
+            "trace [on [rate] | off | reset | export <path>]",
+        ]}
+
+    def cmd_clients(self):
+        now = time.monotonic()
+        clients = []
+        for client in self.snapshot_clients():
+            try:
+                peer = client.c_sock.getpeername()
+                peer = f"[{peer[0]}]:{peer[1]}"
+            except (OSError, AttributeError, IndexError, TypeError):
+                peer = None
+            clients.append({
+                "nickname": client.nickname,
+                "registered": client.is_registered,
+                "peer": peer,
+                "channels": len(client.channels),
+                "idle": round(now - client.last_activity, 3),
+                "rtt_ms": tcp_rtt(client.c_sock),
+                "sendq": unsent_bytes(client.c_sock),
+                "inbuf": len(client.buffer),
+                "outbuf": len(client.outbuf or b""),
+                "throttle": client.throttle.rate if client.throttle is not None else None,
+            })
+        return {"count": len(clients), "clients": clients}
+
+    def cmd_channels(self, name=None):
+        if name is not None:
+            channel = self.server.channels.get(name)
+            if channel is None:
+                raise ValueError(f"no channel {name}")
+            channels = [channel]
+        else:
+            channels = list(self.server.channels.values())
+        result = {}
+        for channel in channels:
+            # One copy per set, so the member list and the op/voice flags describe the same moment
+            members, ops, voiced = list(channel.clients), set(channel.ops), set(channel.voiced)
+            modes, params = channel.mode_string()
+            result[channel.name] = {
+                "modes": " ".join([modes] + params),
+                "members": [("@" if c in ops else "+" if c in voiced else "") + str(c.nickname) for c in members],
+                "bans": len(channel.bans),
+                "excepts": len(channel.excepts),
+            }
+        return {"channels": result}
+
+    def cmd_kill(self, nickname, *reason):
+        self.find_client(nickname).kill(" ".join(reason) or "Killed by an operator")
+        return {}
+
+    def cmd_throttle(self, nickname, rate, burst=None):
+        client = self.find_client(nickname)
+        if rate.lower() == "off":
+            client.throttle = None
+            return {}
+        rate = float(rate)
+        burst = int(burst) if burst is not None else max(1, int(rate))
+        if rate <= 0 or burst <= 0:
+            raise ValueError("rate and burst must be positive")
+        client.throttle = TokenBucket(rate, burst)
+        return {"throttle": rate, "burst": burst}
+
+    def cmd_loglevel(self, level=None):
+        root = logging.getLogger()
+        if level is not None:
+            if not isinstance(logging.getLevelName(level.upper()), int):
+                raise ValueError(f"unknown log level {level}")
+            root.setLevel(level.upper())
+        return {"level": logging.getLevelName(root.level)}
+
+    def cmd_get(self, name=None):
+        tunables = self.server.tunables()
+        if name is not None:
+            if name not in tunables:
+                raise ValueError(f"unknown setting {name}")
+            tunables = {name: tunables[name]}
+        return {"settings": {key: getattr(owner, attr) for key, (owner, attr) in tunables.items()}}
+
+    def cmd_set(self, name, value):
+        tunables = self.server.tunables()
+        if name not in tunables:
+            raise ValueError(f"unknown setting {name}")
+        owner, attr = tunables[name]
+        current = getattr(owner, attr)
+        value = type(current)(value)
+        if value < 0:
+            raise ValueError(f"{name} can't be negative")
+        if value < 1 and name in POSITIVE_TUNABLES:
+            raise ValueError(f"{name} must be at least 1")
+        setattr(owner, attr, value)
+        # Client buckets were built from the old defaults, explicit throttles included
+        if name in ("rate_limit", "rate_burst"):
+            for client in self.snapshot_clients():
+                client.throttle = None
+        logging.warning(f"Admin set {name} from {current} to {value}")
+        return {"settings": {name: value}}
+
+    # Logged channel lines in a time range, start and end as accepted by chanlog.parse_time
+    def cmd_log(self, channel, start, end, limit="1000"):
+        chanlog = self.server.chanlog
+        if chanlog is None:
+            raise ValueError("channel logging is off, start the server with --chanlog")
+        records = query(chanlog.root, channel, parse_time(start), parse_time(end), int(limit))
+        return {"lines": [{"time": timestamp, "line": line} for timestamp, line in records], "writer": chanlog.snapshot()}
+
+    # Delivery latency histograms, see tracing.py. "trace on 0.1" traces 10% of messages.
+    def cmd_trace(self, action=None, arg=None):
+        tracer = self.server.tracer
+        if action == "on":
+            rate = float(arg) if arg is not None else None
+            if rate is not None and not 0 < rate <= 1:
+                raise ValueError("sample rate must be in (0, 1]")
+            if tracer is None:
+                tracer = self.server.tracer = Tracer() if rate is None else Tracer(rate)
+            elif rate is not None:
+                tracer.sample_rate = rate
+        elif action == "off":
+            self.server.tracer = None
+        elif tracer is None:
+            raise ValueError("tracing is off, try trace on")
+        elif action == "reset":
+            tracer.reset()
+        elif action == "export":
+            if arg is None:
+                raise ValueError("export needs a path, .prom for Prometheus format")
+            tracer.export(arg)
+        elif action is not None:
+            raise ValueError(f"unknown trace action {action}")
+        if tracer is None or self.server.tracer is None:
+            return {"tracing": False}
+        return {"tracing": True, **tracer.snapshot()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send commands to a running server's admin socket")
+    parser.add_argument("command", nargs="+", help="Command and arguments, e.g. clients, kill bob, set client_timeout 300")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Admin socket path given to server.py --admin-socket")
+    args = parser.parse_args()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(args.socket)
+        sock.sendall((" ".join(args.command) + "\n").encode("utf-8"))
+        reply = json.loads(sock.makefile("r", encoding="utf-8").readline())
+    print(json.dumps(reply, indent=2))
+    if not reply.get("ok"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
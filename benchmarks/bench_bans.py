@@ -0,0 +1,96 @@
+# Cost of the ban check on JOIN as the ban list grows, indexed vs a linear scan over every mask.
+# Usage: python benchmarks/bench_bans.py [--sizes 10,100,1000,10000] [--checks 2000] [--json]
+import argparse
+import json
+import random
+import re
+import time
+
+from support import make_client, make_server, nick
+from masks import irc_lower, mask_to_regex, normalize_mask
+
+DOMAINS = ["example.com", "example.net", "isp.co.uk", "users.irc.org", "cloud.provider.io"]
+
+
+def random_host(rng):
+    if rng.random() < 0.5:
+        return ".".join(str(rng.randrange(256)) for _ in range(4))
+    return f"host-{rng.randrange(10**6)}.{rng.choice(DOMAINS)}"
+
+
+# A realistic mix: exact hosts, whole subnets, whole domains, nick and ident patterns
+def random_ban(rng):
+    kind = rng.random()
+    if kind < 0.4:
+        return f"*!*@{random_host(rng)}"
+    if kind < 0.6:
+        return f"*!*@{rng.randrange(256)}.{rng.randrange(256)}.*"
+    if kind < 0.75:
+        return f"*!*@*.sub{rng.randrange(10**5)}.{rng.choice(DOMAINS)}"
+    if kind < 0.9:
+        return f"spam{rng.randrange(10**5)}*!*@*"
+    return f"*!~bot{rng.randrange(10**5)}@*"
+
+
+def time_checks(check, clients):
+    start = time.perf_counter()
+    for client in clients:
+        check(client)
+    return (time.perf_counter() - start) / len(clients)
+
+
+def run(sizes, checks, seed=1):
+    rng = random.Random(seed)
+    srv = make_server()
+    clients = []
+    for i in range(checks):
+        client = make_client(srv, nick(i))
+        client.host = random_host(rng)
+        clients.append(client)
+
+    results = []
+    for size in sizes:
+        channel = srv.get_or_create_channel(f"#bans{size}")
+        bans = [random_ban(rng) for _ in range(size)]
+        for mask in bans:
+            channel.bans.add(mask)
+
+        # Cold checks: the match cache is cleared so every check does the full lookup
+        def indexed(client):
+            channel.bans.cache.clear()
+            return channel.join_error(client)
+
+        compiled = [re.compile(mask_to_regex(normalize_mask(mask)), re.DOTALL) for mask in bans]
+
+        def linear(client):
+            hostmask = irc_lower(client.hostmask())
+            return any(pattern.fullmatch(hostmask) for pattern in compiled)
+
+        # Build the compiled groups outside the timing
+        indexed(clients[0])
+        results.append({
+            "bans": size,
+            "indexed_us": round(time_checks(indexed, clients) * 1e6, 2),
+            "linear_us": round(time_checks(linear, clients) * 1e6, 2),
+            "buckets": len(channel.bans.buckets),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JOIN ban check cost against ban list size")
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument("--checks", type=int, default=2000, help="Distinct joining clients per size")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    results = run([int(size) for size in args.sizes.split(",")], args.checks)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'bans':>8} {'indexed us':>12} {'linear us':>12} {'buckets':>8}")
+    for row in results:
+        print(f"{row['bans']:>8} {row['indexed_us']:>12} {row['linear_us']:>12} {row['buckets']:>8}")
+
+
+if __name__ == "__main__":
+    main()
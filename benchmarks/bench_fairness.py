@@ -0,0 +1,167 @@
+# Response latency of quiet clients while flooders fill a busy channel, with the scheduler's per-round
+# and delivery quotas (fair) and with quotas so large that each flooder's whole backlog runs in one turn
+# and its fan-outs pile up in the delivery pool (unfair).
+# The server runs in a subprocess so the load generator doesn't share its GIL.
+# Usage: python benchmarks/bench_fairness.py [--flooders 8] [--listeners 50] [--quiet 5] [--seconds 5] [--json]
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# Quotas per mode: (line_quota, byte_quota, delivery_quota), None keeps the server default
+MODES = {"fair": (None, None, None), "unfair": (10**9, 10**9, 10**9)}
+BURST = 200
+
+
+def serve(port, line_quota, byte_quota, delivery_quota):
+    from support import server
+    srv = server.IRCServer()
+    srv.PORT = port
+    if line_quota is not None:
+        srv.scheduler.line_quota = line_quota
+        srv.scheduler.byte_quota = byte_quota
+        srv.scheduler.delivery_quota = delivery_quota
+    srv.start()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as sock:
+        sock.bind(("::1", 0))
+        return sock.getsockname()[1]
+
+
+def connect(port, nickname, channel=None):
+    sock = socket.create_connection(("::1", port))
+    lines = f"NICK {nickname}\r\nUSER {nickname} 0 * :{nickname}\r\n"
+    if channel:
+        lines += f"JOIN {channel}\r\n"
+    sock.sendall(lines.encode())
+    return sock
+
+
+# Read and discard everything, so the server never blocks sending to this client
+def drain(sock, stop):
+    sock.settimeout(0.5)
+    while not stop.is_set():
+        try:
+            if not sock.recv(65536):
+                return
+        except socket.timeout:
+            continue
+        except OSError:
+            return
+
+
+def flood(sock, stop):
+    burst = "".join(f"PRIVMSG #flood :flood line {i} with some padding to look like chat\r\n" for i in range(BURST)).encode()
+    while not stop.is_set():
+        try:
+            sock.sendall(burst)
+        except OSError:
+            return
+
+
+# PING every interval and time the PONG
+def probe(sock, stop, latencies, interval=0.02):
+    sock.settimeout(10)
+    reader = sock.makefile("rb")
+    n = 0
+    while not stop.is_set():
+        n += 1
+        start = time.perf_counter()
+        try:
+            sock.sendall(f"PING probe{n}\r\n".encode())
+            for line in reader:
+                if line.startswith(b"PONG") and f"probe{n}".encode() in line:
+                    latencies.append(time.perf_counter() - start)
+                    break
+        except OSError:
+            # The server was stopped or the socket closed at the end of the run
+            return
+        time.sleep(interval)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def run_mode(mode, flooders, listeners, quiet, seconds):
+    port = free_port()
+    quotas = [str(quota) for quota in MODES[mode]]
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port), *quotas],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        stop = threading.Event()
+        threads = []
+        socks = []
+        for i in range(listeners):
+            sock = connect(port, f"l{i}", "#flood")
+            socks.append(sock)
+            threads.append(threading.Thread(target=drain, args=(sock, stop)))
+        quiet_socks = [connect(port, f"q{i}") for i in range(quiet)]
+        time.sleep(1)
+        for i in range(flooders):
+            sock = connect(port, f"f{i}", "#flood")
+            socks.append(sock)
+            threads.append(threading.Thread(target=drain, args=(sock, stop)))
+            threads.append(threading.Thread(target=flood, args=(sock, stop)))
+        latencies = []
+        for sock in quiet_socks:
+            threads.append(threading.Thread(target=probe, args=(sock, stop, latencies)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Let the flood build up before measuring
+        time.sleep(1)
+        del latencies[:]
+        time.sleep(seconds)
+        stop.set()
+        measured = list(latencies)
+        for sock in socks + quiet_socks:
+            sock.close()
+    finally:
+        proc.kill()
+        proc.wait()
+    if not measured:
+        return {"mode": mode, "pings": 0}
+    return {
+        "mode": mode,
+        "pings": len(measured),
+        "p50_ms": round(percentile(measured, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(measured, 0.99) * 1000, 2),
+        "max_ms": round(max(measured) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quiet client latency under a flood, fair vs unfair scheduling")
+    parser.add_argument("--flooders", type=int, default=8)
+    parser.add_argument("--listeners", type=int, default=50, help="Members of the flooded channel")
+    parser.add_argument("--quiet", type=int, default=5, help="Clients measuring PING latency")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--modes", default="fair,unfair")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--serve", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        port, *quotas = args.serve
+        serve(int(port), *(None if quota == "None" else int(quota) for quota in quotas))
+        return
+
+    results = [run_mode(mode, args.flooders, args.listeners, args.quiet, args.seconds) for mode in args.modes.split(",")]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':>8} {'pings':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for row in results:
+        print(f"{row['mode']:>8} {row['pings']:>6} {row.get('p50_ms', '-'):>8} {row.get('p99_ms', '-'):>8} {row.get('max_ms', '-'):>8}")
+
+
+if __name__ == "__main__":
+    main()
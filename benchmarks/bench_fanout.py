@@ -0,0 +1,137 @@
+# Inline vs pooled channel delivery with one large and many small channels. One thread keeps posting
+# to the large channel while others post to small ones; we time how long senders are held up and how
+# long small channel messages take to reach their last member.
+# Usage: python benchmarks/bench_fanout.py [--large 2000] [--small 20] [--messages 20] [--json]
+import argparse
+import json
+import random
+import threading
+import time
+
+from support import FakeSocket, make_client, make_server, nick
+
+SMALL_SIZE = 10
+SMALL_SENDERS = 4
+
+
+class SyscallSocket(FakeSocket):
+    # A send gives up the GIL like a real send() syscall does, and small channel members note when
+    # each message id reaches them
+    __slots__ = ("arrivals",)
+
+    def __init__(self, fd, arrivals=None):
+        super().__init__(fd)
+        self.arrivals = arrivals
+
+    def send(self, data):
+        time.sleep(0)
+        if self.arrivals is not None and b"PRIVMSG" in data:
+            msg_id = data.rsplit(b":", 1)[1].strip()
+            now = time.perf_counter()
+            if now > self.arrivals.get(msg_id, 0):
+                self.arrivals[msg_id] = now
+        return FakeSocket.send(self, data)
+
+    sendall = send
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def ms(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000, 3)
+
+
+def run_mode(mode, large, small, messages, seed=1):
+    rng = random.Random(seed)
+    srv = make_server()
+    if mode == "pooled":
+        srv.delivery.start()
+    arrivals = {}
+    big = [make_client(srv, nick(i), SyscallSocket(i + 3)) for i in range(large)]
+    # Joining one by one is quadratic in the channel size, so the large channel is filled directly
+    channel = srv.get_or_create_channel("#big")
+    channel.clients.extend(big)
+    channel.ops.add(big[0])
+    for client in big:
+        client.add_channel_entry("#big", channel)
+    channels = []
+    for c in range(small):
+        members = [make_client(srv, f"s{c}_{i}", SyscallSocket(large + c * SMALL_SIZE + i + 3, arrivals)) for i in range(SMALL_SIZE)]
+        for client in members:
+            client.join_channel(f"#small{c}")
+        channels.append(members)
+    srv.delivery.drain()
+    arrivals.clear()
+
+    big_returns = []
+    small_returns = []
+    sent_at = {}
+    stop = threading.Event()
+    lock = threading.Lock()
+
+    def post_big():
+        for i in range(messages):
+            start = time.perf_counter()
+            big[0].process_message(f"PRIVMSG #big :big{i}")
+            big_returns.append(time.perf_counter() - start)
+        stop.set()
+
+    def post_small(worker):
+        i = 0
+        while not stop.is_set():
+            with lock:
+                c = rng.randrange(small)
+            msg_id = f"w{worker}m{i}"
+            i += 1
+            start = sent_at[msg_id.encode()] = time.perf_counter()
+            channels[c][0].process_message(f"PRIVMSG #small{c} :{msg_id}")
+            small_returns.append(time.perf_counter() - start)
+            time.sleep(0.001)
+
+    start = time.perf_counter()
+    # Small senders go first so they are already posting when the large channel's fan-out begins
+    threads = [threading.Thread(target=post_small, args=(w,)) for w in range(SMALL_SENDERS)] + [threading.Thread(target=post_big)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    srv.delivery.drain()
+    elapsed = time.perf_counter() - start
+
+    latencies = [arrivals[msg_id] - sent for msg_id, sent in sent_at.items() if msg_id in arrivals]
+    return {
+        "mode": mode,
+        "elapsed_s": round(elapsed, 3),
+        "large_sender_return_ms": {"p50": ms(percentile(big_returns, 0.5)), "p99": ms(percentile(big_returns, 0.99))},
+        "small_sender_return_ms": {"p50": ms(percentile(small_returns, 0.5)), "p99": ms(percentile(small_returns, 0.99))},
+        "small_delivery_ms": {"p50": ms(percentile(latencies, 0.5)), "p99": ms(percentile(latencies, 0.99)), "messages": len(latencies)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inline vs pooled channel fan-out, mixed channel sizes")
+    parser.add_argument("--large", type=int, default=2000, help="Members of the large channel")
+    parser.add_argument("--small", type=int, default=20, help=f"Number of {SMALL_SIZE} member channels")
+    parser.add_argument("--messages", type=int, default=20, help="Messages posted to the large channel")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    results = [run_mode(mode, args.large, args.small, args.messages) for mode in ("inline", "pooled")]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':>8} {'elapsed s':>10} {'large send p50/p99 ms':>24} {'small send p50/p99 ms':>24} {'small delivery p50/p99 ms':>28}")
+    for row in results:
+        big, small, delivery = row["large_sender_return_ms"], row["small_sender_return_ms"], row["small_delivery_ms"]
+        print(f"{row['mode']:>8} {row['elapsed_s']:>10} {str(big['p50']) + ' / ' + str(big['p99']):>24} "
+              f"{str(small['p50']) + ' / ' + str(small['p99']):>24} {str(delivery['p50']) + ' / ' + str(delivery['p99']):>28}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Memory cost of idle registered connections and channel memberships.
+# Usage: python benchmarks/bench_memory.py [--clients 20000] [--joins 2] [--channel-size 50] [--json]
+import argparse
+import gc
+import json
+import threading
+import tracemalloc
+
+from support import FakeSocket, make_client, make_server, nick, server
+
+
+def measure(clients, joins, channel_size):
+    srv = make_server()
+    # Socket objects stand in for kernel sockets and are left out of the measurement
+    socks = [FakeSocket(i + 3) for i in range(clients)]
+    srv.clients = []
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+
+    created = [make_client(srv, nick(i), socks[i]) for i in range(clients)]
+    gc.collect()
+    after_clients = tracemalloc.get_traced_memory()[0]
+
+    # Each client joins `joins` channels of roughly channel_size members
+    channels = max(1, clients * joins // channel_size)
+    memberships = 0
+    for i, client in enumerate(created):
+        for j in range(joins):
+            client.join_channel(f"#c{(i * joins + j) % channels}")
+            memberships += 1
+    gc.collect()
+    after_joins = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    per_client = (after_clients - base) / clients
+    per_membership = (after_joins - after_clients) / memberships
+    return {
+        "clients": clients,
+        "channels": len(srv.channels),
+        "memberships": memberships,
+        "bytes_per_client": round(per_client, 1),
+        "bytes_per_membership": round(per_membership, 1),
+        # Python heap for 100k clients in one channel each
+        "heap_100k_mib": round(100000 * (per_client + per_membership) / 2**20, 1),
+    }
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+# Resident memory of idle client threads, which only touch a few pages of their stack reservation
+def measure_threads(count):
+    before = rss_bytes()
+    if before is None:
+        return {}
+    threading.stack_size(server.THREAD_STACK_SIZE)
+    release = threading.Event()
+    threads = [threading.Thread(target=release.wait, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    after = rss_bytes()
+    release.set()
+    for thread in threads:
+        thread.join()
+    threading.stack_size(0)
+    return {
+        "threads": count,
+        "thread_stack_reserved_bytes": server.THREAD_STACK_SIZE,
+        "thread_rss_bytes": round((after - before) / count, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes per idle connection and per channel membership")
+    parser.add_argument("--clients", type=int, default=20000)
+    parser.add_argument("--joins", type=int, default=2, help="Channels joined by each client")
+    parser.add_argument("--channel-size", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=2000, help="Idle threads to start for the per-thread RSS figure, 0 to skip")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    args = parser.parse_args()
+    result = measure(args.clients, args.joins, args.channel_size)
+    if args.threads:
+        result.update(measure_threads(args.threads))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            print(f"{key:>28}: {value}")
+
+
+if __name__ == "__main__":
+    main()
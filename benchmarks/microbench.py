@@ -0,0 +1,232 @@
+# Microbenchmarks for the server's hot paths: command dispatch, nickname checks and lookups, JOIN and
+# PRIVMSG fan-out, driven over fake sockets in process.
+# Usage:
+#   python benchmarks/microbench.py run [--out base.json] [--filter fanout] [--samples 200]
+#   python benchmarks/microbench.py compare base.json new.json [--threshold 0.10]
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+
+from support import make_client, make_server, nick
+
+SAMPLES = 200
+# Each sample times a batch of calls long enough to read reliably off perf_counter
+SAMPLE_TIME = 0.001
+SIZES = (10, 100, 1000)
+LOOKUP_SIZES = (100, 1000, 10000)
+# Relative slowdown of the median above which compare reports a regression
+THRESHOLD = 0.10
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+# Calls per sample so a sample takes about SAMPLE_TIME
+def calibrate(fn):
+    batch = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(batch):
+            fn()
+        if time.perf_counter() - start >= SAMPLE_TIME or batch >= 1 << 20:
+            return batch
+        batch *= 2
+
+
+# Per call timings over many samples, with the garbage collector off like timeit
+def measure(fn, samples):
+    batch = calibrate(fn)
+    times = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(samples):
+            start = time.perf_counter()
+            for _ in range(batch):
+                fn()
+            times.append((time.perf_counter() - start) / batch)
+    finally:
+        gc.enable()
+    median = percentile(times, 0.50)
+    return {
+        "median_us": round(median * 1e6, 3),
+        "p99_us": round(percentile(times, 0.99) * 1e6, 3),
+        "ops_per_sec": round(1 / median) if median > 0 else None,
+        "samples": samples,
+        "batch": batch,
+    }
+
+
+# A server with `size` registered clients, all members of #bench
+def populated(size, channel="#bench"):
+    srv = make_server()
+    clients = [make_client(srv, nick(i)) for i in range(size)]
+    for client in clients:
+        client.join_channel(channel)
+    return srv, clients
+
+
+def dispatch_benchmarks():
+    srv, clients = populated(100)
+    me, other = clients[0], clients[1]
+    nicknames = [f"nick{i}" for i in range(2)]
+    turn = [0]
+
+    # Alternates between two nicknames so every call is a real change
+    def nick_change():
+        turn[0] ^= 1
+        me.process_message(f"NICK {nicknames[turn[0]]}")
+
+    lines = {
+        "PING": "PING :token",
+        "PRIVMSG_user": f"PRIVMSG {other.nickname} :hello there",
+        "PRIVMSG_channel": "PRIVMSG #bench :hello everyone",
+        "JOIN_member": "JOIN #bench",
+        "MODE_query": "MODE #bench",
+        "WHO_channel": "WHO #bench",
+        "ISON": f"ISON {other.nickname} nobody",
+        "LUSERS": "LUSERS",
+        "unknown": "FOO bar",
+    }
+    benches = {f"dispatch/{name}": (lambda line=line: me.process_message(line)) for name, line in lines.items()}
+    benches["dispatch/NICK"] = nick_change
+    return benches
+
+
+def nickname_benchmarks():
+    _, clients = populated(1)
+    client = clients[0]
+    return {
+        "is_valid_nickname/valid": lambda: client.is_valid_nickname("Valid_Nick[1]"),
+        "is_valid_nickname/invalid": lambda: client.is_valid_nickname("1nvalid nick"),
+    }
+
+
+def lookup_benchmarks():
+    benches = {}
+    for size in LOOKUP_SIZES:
+        srv = make_server()
+        clients = [make_client(srv, nick(i)) for i in range(size)]
+        last = clients[-1].nickname
+        benches[f"find_client/{size}/last"] = lambda c=clients[0], n=last: c._find_client_by_nickname(n)
+        benches[f"find_client/{size}/missing"] = lambda c=clients[0]: c._find_client_by_nickname("nobody")
+    return benches
+
+
+def join_benchmarks():
+    benches = {}
+    for size in SIZES:
+        srv, clients = populated(size)
+        joiner = make_client(srv, "joiner")
+        channel = srv.channels["#bench"]
+
+        # Leaving again keeps the channel at `size` members for the next call
+        def join_and_leave(joiner=joiner, channel=channel):
+            joiner.join_channel("#bench")
+            channel.remove_client(joiner, notify=False)
+            joiner.leave_channel_entry("#bench")
+
+        benches[f"join_channel/{size}"] = join_and_leave
+    return benches
+
+
+def fanout_benchmarks():
+    benches = {}
+    for size in SIZES:
+        _, clients = populated(size)
+        benches[f"fanout/{size}"] = lambda sender=clients[0]: sender.process_message("PRIVMSG #bench :hello everyone")
+    # Every tenth member has a SILENCE list, one of which silences the sender
+    for size in SIZES:
+        _, clients = populated(size)
+        for i, client in enumerate(clients[1::10]):
+            client.process_message(f"SILENCE +{'u0' if i == 0 else f'spam{i}'}!*@*,+*!*@spam{i}.example.com")
+        benches[f"fanout_silence/{size}"] = lambda sender=clients[0]: sender.process_message("PRIVMSG #bench :hello everyone")
+    return benches
+
+
+GROUPS = (dispatch_benchmarks, nickname_benchmarks, lookup_benchmarks, join_benchmarks, fanout_benchmarks)
+
+
+def run(name_filter=None, samples=SAMPLES):
+    results = {}
+    for group in GROUPS:
+        for name, fn in group().items():
+            if name_filter and name_filter not in name:
+                continue
+            results[name] = measure(fn, samples)
+            print(f"{name:<32} {results[name]['median_us']:>10} us  p99 {results[name]['p99_us']:>10} us", file=sys.stderr)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+# Benchmarks whose median got slower than threshold allows, plus the full comparison
+def compare(base, new, threshold=THRESHOLD):
+    rows = []
+    for name, after in new["results"].items():
+        before = base["results"].get(name)
+        if before is None:
+            continue
+        ratio = after["median_us"] / before["median_us"] if before["median_us"] else None
+        rows.append({
+            "name": name,
+            "base_us": before["median_us"],
+            "new_us": after["median_us"],
+            "change": round(ratio - 1, 3) if ratio is not None else None,
+            "regression": ratio is not None and ratio > 1 + threshold,
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server hot path microbenchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the benchmarks and write JSON results")
+    run_parser.add_argument("--out", help="Write results here instead of stdout")
+    run_parser.add_argument("--filter", help="Only run benchmarks whose name contains this")
+    run_parser.add_argument("--samples", type=int, default=SAMPLES)
+    compare_parser = commands.add_parser("compare", help="Compare two result files, exit 1 on a regression")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=THRESHOLD, help="Allowed median slowdown, 0.10 for 10%%")
+    compare_parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run(args.filter, args.samples)
+        if args.out:
+            with open(args.out, "w") as out:
+                json.dump(results, out, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+        return
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = compare(base, new, args.threshold)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print(f"{'benchmark':<32} {'base us':>10} {'new us':>10} {'change':>8}")
+        for row in rows:
+            change = f"{row['change']:+.1%}" if row["change"] is not None else "-"
+            print(f"{row['name']:<32} {row['base_us']:>10} {row['new_us']:>10} {change:>8}{'  REGRESSION' if row['regression'] else ''}")
+    if any(row["regression"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
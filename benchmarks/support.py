@@ -0,0 +1,62 @@
+# Helpers shared by the benchmarks: fake sockets and pre-registered clients, no real network
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The server logs every line at INFO, which would dominate any measurement
+logging.disable(logging.CRITICAL)
+
+import server  # noqa: E402
+
+
+class FakeSocket:
+    # Stands in for a connected client socket. Sent bytes are counted, not stored.
+    __slots__ = ("fd", "sent", "closed")
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.sent = 0
+        self.closed = False
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    sendall = send
+
+    def recv(self, size):
+        return b""
+
+    def fileno(self):
+        return -1 if self.closed else self.fd
+
+    def getpeername(self):
+        return ("::1", 10000 + self.fd % 50000, 0, 0)
+
+    def settimeout(self, timeout):
+        pass
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def make_server():
+    return server.IRCServer()
+
+
+# A client that has completed NICK/USER registration on srv
+def make_client(srv, nickname, sock=None):
+    client = server.IRCClient(sock if sock is not None else FakeSocket(len(srv.clients) + 3), srv)
+    srv.clients.append(client)
+    client.process_message(f"NICK {nickname}")
+    client.process_message(f"USER {nickname} 0 * :{nickname}")
+    return client
+
+
+def nick(i):
+    return f"u{i}"
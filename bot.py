@@ -1,61 +1,269 @@
-import socket
-import re
-import random
+import asyncio
 import argparse
+import collections
+import concurrent.futures
+import logging
+import threading
 import time
 
+from factstore import FactLibrary
+from roster import Rosters, ircLower
+from sendqueue import LOW, NORMAL, SEND_BURST, SEND_RATE, URGENT, SendQueue
+
 host = "::1"
 port = 6667
 name = "SwagBot"  # Combined nickname and realname into a single 'name' attribute
 channel = "#test"
 userlist = []
 
+# Upper bound for handlers running off the I/O loop
+WORKER_THREADS = 4
+CONNECT_TIMEOUT = 15
+
+
+class Message:
+    # A single parsed IRC line: [@tags] [:prefix] COMMAND [params...] [:trailing]
+    def __init__(self, prefix, command, params, receivedAt=None):
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self.receivedAt = receivedAt if receivedAt is not None else time.monotonic()
+
+    @classmethod
+    def parse(cls, line):
+        line = line.rstrip("\r\n")
+        # Message tags are not used by the bot, skip them
+        if line.startswith("@"):
+            _, _, line = line.partition(" ")
+        prefix = None
+        if line.startswith(":"):
+            prefix, _, line = line[1:].partition(" ")
+        line = line.lstrip(" ")
+        if " :" in line:
+            line, trailing = line.split(" :", 1)
+            params = line.split()
+            params.append(trailing)
+        elif line.startswith(":"):
+            params = [line[1:]]
+        else:
+            params = line.split()
+        if not params:
+            return None
+        command = params.pop(0).upper()
+        return cls(prefix, command, params)
+
+    # Nickname part of the prefix (nick!user@host)
+    @property
+    def nick(self):
+        if not self.prefix:
+            return None
+        return self.prefix.split("!", 1)[0]
+
+    # Last parameter, usually the message text
+    @property
+    def trailing(self):
+        return self.params[-1] if self.params else ""
+
+    def __repr__(self):
+        return f"Message({self.prefix!r}, {self.command!r}, {self.params!r})"
+
+
+class CommandRegistry:
+    # Maps "!command" words to bot handlers. Blocking handlers are run on a worker thread.
+    def __init__(self):
+        self.handlers = {}
+
+    def command(self, word, blocking=False):
+        def decorator(func):
+            self.handlers[word.lower()] = (func, blocking)
+            return func
+        return decorator
+
+    # Returns (handler, blocking, args) for a message text, or (None, False, []) if no command matches
+    def lookup(self, text):
+        words = text.split()
+        if not words or words[0].lower() not in self.handlers:
+            return None, False, []
+        handler, blocking = self.handlers[words[0].lower()]
+        return handler, blocking, words[1:]
+
+
+commands = CommandRegistry()
+
+
+class Metrics:
+    # Per-connection counters and a window of recent reply latencies.
+    # Only updated from the event loop thread.
+    def __init__(self, window=1024):
+        self.messagesHandled = 0
+        self.repliesSent = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def recordReply(self, message):
+        self.repliesSent += 1
+        self.latencies.append(time.monotonic() - message.receivedAt)
+
+    def snapshot(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 3)
+
+        return {
+            "messagesHandled": self.messagesHandled,
+            "repliesSent": self.repliesSent,
+            "connects": self.connects,
+            "disconnects": self.disconnects,
+            "replyLatencyMs": {"p50": percentile(0.50), "p99": percentile(0.99), "max": percentile(1.0)},
+        }
+
+
 class Socket:
-    def __init__(self, host, port):
+    # executor may be shared between many connections on one loop, see bothost.py
+    def __init__(self, host, port, executor=None, rate=SEND_RATE, burst=SEND_BURST):
         self.host = host
         self.port = port
+        self.loop = None
+        self.writer = None
+        self.loopThread = None
+        self.executor = executor
+        self.metrics = Metrics()
+        # Everything sent to the server goes through this paced queue
+        self.queue = SendQueue(rate, burst)
 
     def connectToServer(self, bot):
-        with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as s:
-            s.connect((self.host, self.port))
-            s.send(bot.botRegistration())
-            s.send(bot.botJoinChannel())
-            self.keepalive(s, bot)
-
-    def keepalive(self, s, swagBot):
+        try:
+            asyncio.run(self.run(bot))
+        except KeyboardInterrupt:
+            pass
+
+    async def run(self, bot):
+        self.loop = asyncio.get_running_loop()
+        self.loopThread = threading.get_ident()
+        ownExecutor = self.executor is None
+        if ownExecutor:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=WORKER_THREADS)
+        reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT)
+        self.metrics.connects += 1
+        # Lines queued for the previous connection are meaningless on a new one
+        self.queue.clear()
+        sender = asyncio.ensure_future(self.queue.run(self.writer))
+        try:
+            self.send(bot.botRegistration(), URGENT)
+            self.send(bot.botJoinChannel())
+            await self.keepalive(reader, bot)
+        finally:
+            self.metrics.disconnects += 1
+            sender.cancel()
+            self.writer.close()
+            if ownExecutor:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+    # Read CRLF framed lines and dispatch each one as an event
+    async def keepalive(self, reader, bot):
         while True:
-            try:
-                response = s.recv(2048).decode()
-                if response.startswith("PING"):
-                    self.pong(s, response)
-                elif "353" in response:
-                    response = re.findall("353(.*?)\n" , response)
-                    self.initUserlist(response, swagBot)
-                elif "PRIVMSG" in response:
-                    swagBot.funnyfact(s, response)
-                    if "!hello" in response:
-                        swagBot.greet(s, response)
-                    elif "!slap" in response:
-                        swagBot.slap(s, response)
-                    elif "!rename" in response:
-                        swagBot.rename(s, response)
-                elif "JOIN" in response:
-                    swagBot.addUser(response)
-                elif "QUIT" in response:
-                    swagBot.removeUser(response)
-            except KeyboardInterrupt:
+            line = await reader.readline()
+            if not line:
                 break
+            message = Message.parse(line.decode("utf-8", errors="replace"))
+            if message is not None:
+                self.dispatch(bot, message)
+
+    def dispatch(self, bot, message):
+        handler = self.events.get(message.command)
+        if handler is not None:
+            self.metrics.messagesHandled += 1
+            handler(self, bot, message)
+
+    def onPing(self, bot, message):
+        self.pong(message.trailing)
+
+    def onNames(self, bot, message):
+        self.initUserlist(message, bot)
+
+    def onEndOfNames(self, bot, message):
+        # RPL_ENDOFNAMES: <me> <channel> :End of NAMES list
+        if len(message.params) >= 2:
+            bot.rosters.endOfNames(message.params[1])
+
+    def onJoin(self, bot, message):
+        if message.params:
+            bot.addUser(message.params[0], message.nick)
+
+    def onPart(self, bot, message):
+        if message.params:
+            bot.removeUser(message.params[0], message.nick)
+
+    def onKick(self, bot, message):
+        # KICK <channel> <user> [:reason]
+        if len(message.params) >= 2:
+            bot.removeUser(message.params[0], message.params[1])
+
+    def onQuit(self, bot, message):
+        bot.rosters.quit(message.nick)
+
+    def onNick(self, bot, message):
+        if message.params:
+            bot.renameUser(message.nick, message.params[0])
+
+    def onPrivmsg(self, bot, message):
+        if len(message.params) < 2:
+            return
+        handler, blocking, args = commands.lookup(message.trailing)
+        if handler is not None:
+            self.runHandler(handler, blocking, bot, message, args)
+        elif message.params[0] == bot.name:
+            self.runHandler(Bot.funnyfact, True, bot, message, [])
+
+    events = {
+        "PING": onPing,
+        "353": onNames,
+        "366": onEndOfNames,
+        "JOIN": onJoin,
+        "PART": onPart,
+        "KICK": onKick,
+        "QUIT": onQuit,
+        "NICK": onNick,
+        "PRIVMSG": onPrivmsg,
+    }
+
+    # Run a handler inline or, when it may block, on the worker pool so PINGs keep flowing
+    def runHandler(self, handler, blocking, bot, message, args):
+        if not blocking:
+            handler(bot, self, message, args)
+            return
+        future = self.loop.run_in_executor(self.executor, handler, bot, self, message, args)
+        future.add_done_callback(self.handlerDone)
+
+    def handlerDone(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error("Handler failed: " + repr(future.exception()))
+
+    # Queue a line for the server. Safe to call from worker threads.
+    def send(self, line, priority=NORMAL, key=None, onSent=None):
+        data = line.encode() if isinstance(line, str) else line
+        if threading.get_ident() == self.loopThread:
+            self.queue.put(data, priority, key, onSent)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put, data, priority, key, onSent)
 
-    def pong(self, s, text):
-        ping_message = text.split(" ")[1]
-        response = "PONG " + ping_message + "\r\n"
-        s.send(response.encode())
+    # Queue a low priority line answering message. The reply latency is recorded once it is written.
+    # Replies sharing a key replace each other while still queued.
+    def reply(self, message, line, key=None):
+        self.send(line, LOW, key, lambda: self.metrics.recordReply(message))
 
-    def initUserlist(self, users, bot):
-        userlist = users[0].replace("\r", "")
-        userlist = userlist.split(":")
-        userlist = userlist[1].split(" ")
-        bot.userlist = userlist
+    def pong(self, token):
+        self.send("PONG :" + token + "\r\n", URGENT)
+
+    def initUserlist(self, message, bot):
+        # RPL_NAMREPLY: <me> <type> <channel> :<names>, possibly over several lines
+        if len(message.params) >= 4:
+            bot.rosters.names(message.params[2], message.trailing.split())
 
     def getHost(self):
         return self.host
@@ -69,6 +277,7 @@ class Socket:
     def setPort(self, port):
         self.port = port
 
+
 class Menu:
     def __init__(self):
         self.parser = argparse.ArgumentParser(description="IRC Bot Options")
@@ -76,109 +285,145 @@ class Menu:
         self.parser.add_argument("--port", type=int, default=port, help="IRC server port")
         self.parser.add_argument("--name", default=name, help="Bot name")  # Combined nickname and realname into a single 'name' attribute
         self.parser.add_argument("--channel", default=channel, help="Channel to join")
+        self.parser.add_argument("--rate", type=float, default=SEND_RATE, help="Lines per second sent once the burst is used up")
+        self.parser.add_argument("--burst", type=int, default=SEND_BURST, help="Lines that may be sent back to back")
+        self.parser.add_argument("--facts", action="append", default=[], metavar="NAME=PATH", help="Extra fact corpus, may be repeated")
 
     def get_args(self):
         return self.parser.parse_args()
 
+
 class Bot:
-    def __init__(self, name, userlist, channel):
+    # channels lists every channel to join; channel is the default one for replies
+    def __init__(self, name, userlist, channel, facts=None, channels=None):
         self.name = name  # Combined nickname and realname into a single 'name' attribute
-        self.userlist = userlist
         self.channel = channel
-
-    def addUser(self, text):
-        print("This is the current userlist " + str(self.userlist))
-        username = (text.split("!")[0]).strip(":")
-        self.userlist.append(username)
-        print("This is the updated userlist " + str(self.userlist))
-        pass
-
-    def removeUser(self, text):
-        print("This is the current userlist " + str(self.userlist))
-        username = (text.split("!")[0]).strip(":")
-        self.userlist.remove(username)
-        print("This is the updated userlist " + str(self.userlist))
-        pass
-
-    def funnyfact(self, s, text):
-        username = text.split('!')[0].strip(':')
-        message_parts = text.split(' ', 3)
-
-        if len(message_parts) >= 4:
-            target = message_parts[2]
-
-            if target == self.name:
-                factsFile = open("facts.txt", "r")
-                fact = random.choice(factsFile.readlines())
-                response = f"PRIVMSG {username} :Want to hear an amazing fact? {fact}\r\n"
-                factsFile.close()
-                s.send(response.encode())
-
-    def greet(self, s, text):
-        username = text.split('!')[0].strip(':')
-        message_parts = text.split(' ')
-
-        if len(message_parts) >= 4 and message_parts[3] == ":!hello\r\n":
-            current_date = time.strftime("%Y-%m-%d")
-            current_time = time.strftime("%H:%M:%S")
-            greeting = f"Greetings {username}, welcome to the server! The date is {current_date}, and the time is {current_time}."
-            response = f"PRIVMSG {self.channel} :{greeting}\r\n"
-            s.send(response.encode())
-
-    def slap(self, s, text):
-        command_parts = text.split(" ")
-        sender = text.split("!")[0].lstrip(":").lower()
-
-        if len(command_parts) == 5:
-            target_user = command_parts[4].strip("\r\n").lower()
-
-            if target_user == sender:
-                response = f"PRIVMSG {self.channel} :You can't slap yourself!\r\n"
-            elif target_user == self.name.lower():
-                response = f"PRIVMSG {self.channel} :You can't slap the bot!\r\n"
+        self.channels = list(channels) if channels else [channel]
+        self.facts = facts if facts is not None else FactLibrary()
+        self.rosters = Rosters()
+        for user in userlist:
+            self.rosters.join(channel, user)
+
+    # Users of the bot's default channel
+    @property
+    def userlist(self):
+        roster = self.rosters.get(self.channel)
+        return list(roster) if roster is not None else []
+
+    def isMe(self, nick):
+        return nick is not None and ircLower(nick) == ircLower(self.name)
+
+    def addUser(self, channel, username):
+        if username:
+            self.rosters.join(channel, username)
+
+    def removeUser(self, channel, username):
+        if self.isMe(username):
+            # The bot left the channel, its roster is no longer tracked
+            self.rosters.drop(channel)
+        else:
+            self.rosters.part(channel, username)
+
+    def renameUser(self, old, new):
+        if self.isMe(old):
+            self.name = new
+        self.rosters.nick(old, new)
+
+    # Channel the reply should go to: the channel the command came from, or the bot's default channel
+    def replyTarget(self, message):
+        target = message.params[0]
+        return target if target.startswith("#") else self.channel
+
+    # Random fact from corpus, or None after telling target that the corpus file can't be read
+    def randomFact(self, s, message, target, corpus):
+        try:
+            return self.facts.random(corpus)
+        except OSError as e:
+            logging.error(f"Could not read fact corpus {corpus or self.facts.default}: {e}")
+            s.reply(message, f"PRIVMSG {target} :Sorry, I can't reach my facts right now.\r\n")
+            return None
+
+    # Private message to the bot: reply with a fact, from the corpus named by the first word if there is one
+    def funnyfact(self, s, message, args):
+        words = message.trailing.split()
+        corpus = words[0] if words and words[0] in self.facts else None
+        fact = self.randomFact(s, message, message.nick, corpus)
+        if fact:
+            s.reply(message, f"PRIVMSG {message.nick} :Want to hear an amazing fact? {fact}\r\n", ("fact", message.nick))
+
+    @commands.command("!fact", blocking=True)
+    def fact(self, s, message, args):
+        target = self.replyTarget(message)
+        corpus = args[0] if args else None
+        if corpus is not None and corpus not in self.facts:
+            s.reply(message, f"PRIVMSG {target} :Unknown corpus {corpus}. Try one of: {', '.join(self.facts.names())}\r\n")
+            return
+        fact = self.randomFact(s, message, target, corpus)
+        if fact:
+            s.reply(message, f"PRIVMSG {target} :Did you know? {fact}\r\n", ("!fact", target))
+
+    @commands.command("!hello")
+    def greet(self, s, message, args):
+        current_date = time.strftime("%Y-%m-%d")
+        current_time = time.strftime("%H:%M:%S")
+        greeting = f"Greetings {message.nick}, welcome to the server! The date is {current_date}, and the time is {current_time}."
+        s.reply(message, f"PRIVMSG {self.replyTarget(message)} :{greeting}\r\n", ("!hello", message.nick))
+
+    @commands.command("!slap")
+    def slap(self, s, message, args):
+        sender = message.nick
+        target = self.replyTarget(message)
+
+        if args:
+            target_user = args[0]
+
+            if ircLower(target_user) == ircLower(sender):
+                response = f"PRIVMSG {target} :You can't slap yourself!\r\n"
+            elif self.isMe(target_user):
+                response = f"PRIVMSG {target} :You can't slap the bot!\r\n"
             else:
-                response = f"PRIVMSG {self.channel} :{sender} slaps {target_user} around with a large trout!\r\n"
+                response = f"PRIVMSG {target} :{sender} slaps {target_user} around with a large trout!\r\n"
         else:
-            available_users = [user.lower() for user in self.userlist if user.lower() != self.name.lower() and user.lower() != sender]
-            if available_users:
-                target_user = random.choice(available_users)
-                response = f"PRIVMSG {self.channel} :{sender} slaps {target_user} around with a large trout!\r\n"
-        s.send(response.encode())
+            roster = self.rosters.get(target)
+            if roster is None:
+                return
+            target_user = roster.random(exclude={ircLower(self.name), ircLower(sender)})
+            if target_user is None:
+                return
+            response = f"PRIVMSG {target} :{sender} slaps {target_user} around with a large trout!\r\n"
+        s.reply(message, response, ("!slap", target))
 
-    def rename(self, s, text):
-        command_parts = text.split(" ")
-        print(command_parts)
+    @commands.command("!rename")
+    def rename(self, s, message, args):
+        target = self.replyTarget(message)
 
-        if len(command_parts) == 5:
-            new_name = command_parts[4].strip("\r\n")
+        if len(args) == 1:
+            new_name = args[0]
 
-            # Update the bot's name
-            self.name = new_name
+            # Update the bot's name and its entry in every roster; the server doesn't echo our own NICK
+            self.renameUser(self.name, new_name)
 
-            # Re-register the bot with the new name
-            registration = self.botRegistration()
-            s.send(registration)
+            # Change the bot's nickname on the server
+            s.send(f"NICK {new_name}\r\n")
 
             # Send a message to the channel about the renaming
-            response = f"PRIVMSG {self.channel} :I have been renamed to {new_name}!\r\n"
-            s.send(response.encode())
+            s.reply(message, f"PRIVMSG {target} :I have been renamed to {new_name}!\r\n")
         else:
-            response = f"PRIVMSG {self.channel} :Invalid syntax. Use !rename new_name to rename the bot.\r\n"
-            s.send(response.encode())
+            s.reply(message, f"PRIVMSG {target} :Invalid syntax. Use !rename new_name to rename the bot.\r\n")
 
     def botRegistration(self):
         user = "NICK " + self.name +  "\r\nUSER " + self.name + " 0 * " + ":" + self.name +"\r\n"  # Use 'name' for both nickname and realname
         return user.encode()
 
     def botJoinChannel(self):
-        join = f"JOIN {self.channel}\r\n"
+        join = "".join(f"JOIN {ch}\r\n" for ch in self.channels)
         return join.encode()
 
 def main():
     menu = Menu()
     args = menu.get_args()
-    clientSocket = Socket(args.host, args.port)
-    bot = Bot(args.name, [], args.channel)
+    clientSocket = Socket(args.host, args.port, rate=args.rate, burst=args.burst)
+    bot = Bot(args.name, [], args.channel, FactLibrary.fromSpecs(args.facts))
     clientSocket.connectToServer(bot)
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+import asyncio
+import argparse
+import concurrent.futures
+import json
+import random
+import time
+
+from bot import Bot, Socket
+from factstore import DEFAULT_CORPUS, DEFAULT_PATH, FactLibrary, FactStore
+from sendqueue import SEND_BURST, SEND_RATE
+
+# Reconnect backoff: exponential from BACKOFF_BASE up to BACKOFF_CAP seconds, with full jitter
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 120.0
+# A connection that stayed up this long resets the backoff
+STABLE_AFTER = 60.0
+
+# Example config:
+# {
+#   "defaults": {"host": "::1", "port": 6667, "sendRate": 1.0, "sendBurst": 5, "facts": {"animals": "animals.txt"}},
+#   "bots": [
+#     {"name": "SwagBot", "channels": ["#test", "#ops"]},
+#     {"name": "OtherBot", "host": "fc00:1337::17", "channels": ["#lobby"]}
+#   ]
+# }
+
+
+class BotInstance:
+    # One bot identity with its own connection state, reconnected with jittered backoff
+    def __init__(self, spec, executor, libraries):
+        self.name = spec["name"]
+        self.host = spec.get("host", "::1")
+        self.port = int(spec.get("port", 6667))
+        channels = spec.get("channels") or ["#test"]
+        self.socket = Socket(self.host, self.port, executor, float(spec.get("sendRate", SEND_RATE)), int(spec.get("sendBurst", SEND_BURST)))
+        self.bot = Bot(self.name, [], channels[0], libraries.get(spec.get("facts") or {}), channels)
+        self.attempts = 0
+        self.lastError = None
+
+    def backoff(self):
+        delay = min(BACKOFF_CAP, BACKOFF_BASE * (2 ** self.attempts))
+        return random.uniform(0, delay)
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.socket.run(self.bot)
+                self.lastError = "connection closed"
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.TimeoutError) as e:
+                self.lastError = repr(e)
+            except Exception as e:
+                self.lastError = repr(e)
+                print(f"[{self.name}] Unexpected error: {e!r}")
+            if time.monotonic() - started >= STABLE_AFTER:
+                self.attempts = 0
+            delay = self.backoff()
+            self.attempts += 1
+            print(f"[{self.name}] Disconnected from {self.host}:{self.port} ({self.lastError}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def snapshot(self):
+        stats = self.socket.metrics.snapshot()
+        stats.update({"name": self.bot.name, "server": f"{self.host}:{self.port}", "channels": self.bot.channels, "lastError": self.lastError})
+        stats["sendQueue"] = self.socket.queue.snapshot()
+        return stats
+
+
+class FactLibraries:
+    # Bots naming the same fact files share one FactStore (and one mmap/index) per path
+    def __init__(self, defaults):
+        self.defaults = defaults
+        self.stores = {}
+
+    def store(self, path):
+        if path not in self.stores:
+            self.stores[path] = FactStore(path)
+        return self.stores[path]
+
+    def get(self, corpora):
+        merged = {DEFAULT_CORPUS: DEFAULT_PATH}
+        merged.update(self.defaults)
+        merged.update(corpora)
+        library = FactLibrary({})
+        for corpus, path in merged.items():
+            library.addStore(corpus, self.store(path))
+        return library
+
+
+class BotHost:
+    # Runs every bot from a config on one event loop
+    def __init__(self, config, workers=8, metricsInterval=60, metricsFile=None):
+        defaults = config.get("defaults", {})
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        libraries = FactLibraries(defaults.get("facts", {}))
+        self.instances = []
+        for spec in config.get("bots", []):
+            merged = dict(defaults)
+            merged.update(spec)
+            self.instances.append(BotInstance(merged, self.executor, libraries))
+        self.metricsInterval = metricsInterval
+        self.metricsFile = metricsFile
+
+    @classmethod
+    def fromFile(cls, path, **kwargs):
+        with open(path, "r") as configFile:
+            return cls(json.load(configFile), **kwargs)
+
+    def snapshot(self):
+        return [instance.snapshot() for instance in self.instances]
+
+    def reportMetrics(self):
+        stats = self.snapshot()
+        if self.metricsFile:
+            with open(self.metricsFile, "w") as out:
+                json.dump({"time": time.time(), "bots": stats}, out, indent=2)
+        else:
+            handled = sum(s["messagesHandled"] for s in stats)
+            replies = sum(s["repliesSent"] for s in stats)
+            connected = sum(1 for s in stats if s["connects"] > s["disconnects"])
+            dropped = sum(s["sendQueue"]["dropped"] for s in stats)
+            queued = sum(s["sendQueue"]["depth"] for s in stats)
+            print(f"{connected}/{len(stats)} bots connected, {handled} messages handled, {replies} replies sent, {queued} lines queued, {dropped} dropped")
+
+    async def metricsLoop(self):
+        while True:
+            await asyncio.sleep(self.metricsInterval)
+            self.reportMetrics()
+
+    async def run(self):
+        tasks = [asyncio.ensure_future(instance.run()) for instance in self.instances]
+        if self.metricsInterval:
+            tasks.append(asyncio.ensure_future(self.metricsLoop()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.reportMetrics()
+            self.executor.shutdown(wait=False)
+
+    def start(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many IRC bots in one process")
+    parser.add_argument("config", help="JSON file describing the bots, servers and channels")
+    parser.add_argument("--workers", type=int, default=8, help="Threads for blocking bot commands, shared by all bots")
+    parser.add_argument("--metrics-interval", type=int, default=60, help="Seconds between metrics reports, 0 to disable")
+    parser.add_argument("--metrics-file", default=None, help="Write per-bot metrics as JSON to this file instead of printing a summary")
+    args = parser.parse_args()
+    host = BotHost.fromFile(args.config, workers=args.workers, metricsInterval=args.metrics_interval, metricsFile=args.metrics_file)
+    host.start()
+
+
+if __name__ == "__main__":
+    main()
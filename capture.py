@@ -0,0 +1,68 @@
+import struct
+import threading
+import time
+
+# Capture file: MAGIC, then records of HEADER + payload.
+# HEADER: seconds since capture start (float64), connection id (uint32), kind (uint8), payload length (uint32)
+MAGIC = b"IRCCAP1\n"
+HEADER = struct.Struct("<dIBI")
+
+OPEN = 1   # payload: peer address
+IN = 2     # payload: one line received from the client, without CRLF
+OUT = 3    # payload: bytes sent to the client
+CLOSE = 4  # payload: empty
+
+KIND_NAMES = {OPEN: "open", IN: "in", OUT: "out", CLOSE: "close"}
+
+
+class TrafficCapture:
+    # Appends timestamped connection traffic to a compact binary log. Safe to use from all client threads.
+    def __init__(self, path, buffer_size=1 << 20):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "wb", buffering=buffer_size)
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        self.next_id = 0
+        self.records = 0
+
+    def new_connection(self, peer):
+        with self.lock:
+            self.next_id += 1
+            conn_id = self.next_id
+        self.record(conn_id, OPEN, str(peer).encode("utf-8"))
+        return conn_id
+
+    def record(self, conn_id, kind, payload):
+        header = HEADER.pack(time.monotonic() - self.start, conn_id, kind, len(payload))
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(header)
+            self.file.write(payload)
+            self.records += 1
+            # Keep what we have on disk once a connection is over
+            if kind == CLOSE:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Yields (timestamp, conn_id, kind, payload) tuples from a capture file
+def read_capture(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a traffic capture")
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            timestamp, conn_id, kind, length = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield timestamp, conn_id, kind, payload
@@ -0,0 +1,274 @@
+import argparse
+import bisect
+import collections
+import datetime
+import logging
+import mmap
+import os
+import re
+import threading
+import time
+from array import array
+from urllib.parse import quote
+
+# Start a new segment once the current one is this big
+SEGMENT_BYTES = 16 * 1024 * 1024
+# One index entry per this many bytes of log, so a lookup scans at most this much of a segment
+INDEX_INTERVAL = 64 * 1024
+FSYNC_INTERVAL = 1.0
+# Lines waiting for the writer; beyond this new lines are dropped rather than slowing senders down
+MAX_PENDING = 100000
+# Line breaks and backslashes in a logged line are escaped, a record never spans two lines
+ESCAPES = {"\\": "\\\\", "\n": "\\n", "\r": "\\r"}
+UNESCAPES = {"n": "\n", "r": "\r"}
+ESCAPED = re.compile(r"\\(.)", re.DOTALL)
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+
+
+def escape(line):
+    if "\\" in line or "\n" in line or "\r" in line:
+        return "".join(ESCAPES.get(char, char) for char in line)
+    return line
+
+
+def unescape(text):
+    if "\\" not in text:
+        return text
+    return ESCAPED.sub(lambda m: UNESCAPES.get(m.group(1), m.group(1)), text)
+
+
+def channel_dir(root, channel):
+    return os.path.join(root, quote(channel, safe=""))
+
+
+# Seconds since the epoch from "1700000000", "10:05" / "10:05:30" (today, local time) or "2024-05-01T10:05"
+def parse_time(text):
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    if "T" not in text and "-" not in text:
+        today = datetime.date.today().isoformat()
+        text = f"{today}T{text}"
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+class Segment:
+    # The segment a channel is currently appending to. Records are "<ms> <escaped line>\n"; the index file
+    # holds (ms, offset) pairs of uint64s, one every INDEX_INTERVAL bytes.
+    def __init__(self, directory, first_ms):
+        path = os.path.join(directory, str(first_ms))
+        # Two segments started in the same millisecond (e.g. after a restart) get distinct names
+        while os.path.exists(path + LOG_SUFFIX):
+            first_ms += 1
+            path = os.path.join(directory, str(first_ms))
+        self.first_ms = first_ms
+        self.log = open(path + LOG_SUFFIX, "ab")
+        self.index = open(path + INDEX_SUFFIX, "ab")
+        self.size = 0
+        self.indexed_at = None
+        self.last_ms = first_ms
+
+    def append(self, ms, line):
+        # Keep timestamps ordered within the segment even if the clock steps back
+        ms = max(ms, self.last_ms)
+        self.last_ms = ms
+        if self.indexed_at is None or self.size - self.indexed_at >= INDEX_INTERVAL:
+            self.index.write(array("Q", (ms, self.size)).tobytes())
+            self.indexed_at = self.size
+        record = f"{ms} {escape(line)}\n".encode("utf-8")
+        self.log.write(record)
+        self.size += len(record)
+
+    def flush(self):
+        self.log.flush()
+        self.index.flush()
+
+    def sync(self):
+        os.fsync(self.log.fileno())
+        os.fsync(self.index.fileno())
+
+    def close(self):
+        self.flush()
+        self.sync()
+        self.log.close()
+        self.index.close()
+
+
+class ChannelLog:
+    # Append-only per-channel message log under root/<channel>/<first ms>.log. append() only queues the
+    # line; a background thread writes batches, flushes after each batch and fsyncs at most every
+    # FSYNC_INTERVAL seconds. Reads map the segment files and don't need the writer.
+    def __init__(self, root, segment_bytes=SEGMENT_BYTES, fsync_interval=FSYNC_INTERVAL, max_pending=MAX_PENDING):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.segments = {}
+        self.unsynced = set()
+        self.written = 0
+        self.dropped = 0
+        self.thread = None
+
+    def start(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="chanlog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue a line for channel. Never blocks: deque.append is atomic and the writer is only woken if idle.
+    def append(self, channel, line, timestamp=None):
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending.append((channel, timestamp if timestamp is not None else time.time(), line))
+        if not self.wakeup.is_set():
+            self.wakeup.set()
+
+    def run(self):
+        last_sync = time.monotonic()
+        while not self.stopped:
+            self.wakeup.wait(self.fsync_interval)
+            self.wakeup.clear()
+            try:
+                self.write_pending()
+                if self.unsynced and time.monotonic() - last_sync >= self.fsync_interval:
+                    self.sync()
+                    last_sync = time.monotonic()
+            except OSError as e:
+                logging.error(f"Channel log write failed: {e}")
+        self.write_pending()
+
+    def write_pending(self):
+        touched = set()
+        while self.pending:
+            channel, timestamp, line = self.pending.popleft()
+            ms = int(timestamp * 1000)
+            segment = self.segments.get(channel)
+            if segment is None or segment.size >= self.segment_bytes:
+                segment = self.rotate(channel, segment, ms)
+            segment.append(ms, line)
+            touched.add(segment)
+            self.written += 1
+        # Flushed batches are visible to readers straight away, fsync comes later.
+        # Segments rotated out during the batch were already closed and synced.
+        touched = {segment for segment in touched if not segment.log.closed}
+        for segment in touched:
+            segment.flush()
+        self.unsynced |= touched
+
+    def rotate(self, channel, old, first_ms):
+        if old is not None:
+            old.close()
+            self.unsynced.discard(old)
+        directory = channel_dir(self.root, channel)
+        os.makedirs(directory, exist_ok=True)
+        segment = self.segments[channel] = Segment(directory, max(first_ms, old.last_ms if old else 0))
+        return segment
+
+    def sync(self):
+        for segment in self.unsynced:
+            segment.sync()
+        self.unsynced.clear()
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+
+    def snapshot(self):
+        return {"pending": len(self.pending), "written": self.written, "dropped": self.dropped, "channels": len(self.segments)}
+
+
+# Segment start times of a channel, oldest first
+def list_segments(root, channel):
+    try:
+        names = os.listdir(channel_dir(root, channel))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-len(LOG_SUFFIX)]) for name in names if name.endswith(LOG_SUFFIX))
+
+
+# (timestamp, line) for every record of channel with start <= timestamp <= end, oldest first.
+# Only segments whose time span overlaps the range are opened.
+def query(root, channel, start, end, limit=None):
+    start_ms, end_ms = int(start * 1000), int(end * 1000)
+    firsts = list_segments(root, channel)
+    results = []
+    for i, first_ms in enumerate(firsts):
+        # A segment covers its first ms up to the next segment's first ms (which may share its last ms)
+        if first_ms > end_ms:
+            break
+        if i + 1 < len(firsts) and firsts[i + 1] < start_ms:
+            continue
+        path = os.path.join(channel_dir(root, channel), str(first_ms))
+        if read_segment(path, start_ms, end_ms, results, limit):
+            break
+    return results
+
+
+# Append matching records of one segment to results. Returns True once limit is reached or the range is past.
+def read_segment(path, start_ms, end_ms, results, limit):
+    index = array("Q")
+    try:
+        with open(path + INDEX_SUFFIX, "rb") as f:
+            data = f.read()
+        index.frombytes(data[:len(data) - len(data) % 16])
+    except FileNotFoundError:
+        pass
+    times, offsets = index[0::2], index[1::2]
+    # Start from the last index entry at or before start_ms
+    position = bisect.bisect_right(times, start_ms) - 1
+    offset = offsets[position] if position >= 0 else 0
+
+    with open(path + LOG_SUFFIX, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= offset:
+            return False
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as view:
+            while offset < size:
+                newline = view.find(b"\n", offset)
+                # A record still being written
+                if newline == -1:
+                    return False
+                space = view.find(b" ", offset, newline)
+                try:
+                    ms = int(view[offset:space]) if space != -1 else None
+                except ValueError:
+                    ms = None
+                # A damaged record is skipped rather than failing the whole query
+                if ms is None:
+                    offset = newline + 1
+                    continue
+                if ms > end_ms:
+                    return True
+                if ms >= start_ms:
+                    results.append((ms / 1000, unescape(view[space + 1:newline].decode("utf-8", errors="replace"))))
+                    if limit is not None and len(results) >= limit:
+                        return True
+                offset = newline + 1
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a channel's logged messages in a time range")
+    parser.add_argument("root", help="Directory given to server.py --chanlog")
+    parser.add_argument("channel")
+    parser.add_argument("start", help="Epoch seconds, HH:MM[:SS] today, or YYYY-MM-DDTHH:MM[:SS]")
+    parser.add_argument("end")
+    parser.add_argument("--limit", type=int)
+    args = parser.parse_args()
+    for timestamp, line in query(args.root, args.channel, parse_time(args.start), parse_time(args.end), args.limit):
+        print(f"{datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds')} {line}")
+
+
+if __name__ == "__main__":
+    main()
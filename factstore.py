@@ -0,0 +1,121 @@
+import mmap
+import os
+import random
+import threading
+from array import array
+
+DEFAULT_CORPUS = "facts"
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "facts.txt")
+
+
+class FactStore:
+    # Serves random lines from a one-fact-per-line file.
+    # A line offset index is built once per file version and lines are sliced out of a
+    # memory map, so picking a fact never reads the whole corpus.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.starts = array("Q")
+        self.ends = array("Q")
+        self.version = None
+
+    def __len__(self):
+        with self.lock:
+            self.refresh()
+            return len(self.starts)
+
+    # (mtime, size) of the file on disk, used to notice edits
+    def stat(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    # Rebuild the map and index if the file changed since it was last loaded
+    def refresh(self):
+        version = self.stat()
+        if version != self.version:
+            self.load(version)
+
+    def load(self, version):
+        self.close()
+        starts = array("Q")
+        ends = array("Q")
+        self.file = open(self.path, "rb")
+        if version[1] > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            start = 0
+            size = len(self.map)
+            while start < size:
+                end = self.map.find(b"\n", start)
+                if end == -1:
+                    end = size
+                # Skip blank lines so every index entry is a real fact
+                if self.map[start:end].strip():
+                    starts.append(start)
+                    ends.append(end)
+                start = end + 1
+        self.starts = starts
+        self.ends = ends
+        self.version = version
+
+    def random(self):
+        with self.lock:
+            self.refresh()
+            if not self.starts:
+                return None
+            i = random.randrange(len(self.starts))
+            return self.map[self.starts[i]:self.ends[i]].decode("utf-8", errors="replace").strip()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.version = None
+
+
+class FactLibrary:
+    # A set of named corpora, e.g. {"facts": "facts.txt", "animals": "animals.txt"}
+    def __init__(self, corpora=None, default=DEFAULT_CORPUS):
+        self.default = default
+        self.stores = {}
+        for corpus, path in (corpora if corpora is not None else {DEFAULT_CORPUS: DEFAULT_PATH}).items():
+            self.add(corpus, path)
+
+    # Build a library from NAME=PATH strings as given on the command line
+    @classmethod
+    def fromSpecs(cls, specs):
+        corpora = {DEFAULT_CORPUS: DEFAULT_PATH}
+        for spec in specs or []:
+            corpus, sep, path = spec.partition("=")
+            if not sep or not corpus or not path:
+                raise ValueError(f"Invalid corpus '{spec}', expected NAME=PATH")
+            corpora[corpus.lower()] = path
+        return cls(corpora)
+
+    def add(self, corpus, path):
+        self.addStore(corpus, FactStore(path))
+
+    # Stores can be shared between libraries, e.g. by many bots in one process
+    def addStore(self, corpus, store):
+        self.stores[corpus.lower()] = store
+
+    def names(self):
+        return sorted(self.stores)
+
+    def __contains__(self, corpus):
+        return corpus is not None and corpus.lower() in self.stores
+
+    # Random fact from the named corpus (the default one if no name is given)
+    def random(self, corpus=None):
+        store = self.stores.get((corpus or self.default).lower())
+        if store is None:
+            return None
+        return store.random()
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
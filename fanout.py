@@ -0,0 +1,159 @@
+import logging
+import queue
+import select
+import threading
+
+WORKERS = 4
+# How long the flusher waits for a socket to become writable before looking for newly backed up clients
+FLUSH_POLL_MS = 50
+
+
+class DeliveryPool:
+    # Sends channel fan-out on worker threads so the sender's thread returns as soon as the line is
+    # queued. Work is sharded by channel name: every line for a channel goes through the same worker,
+    # in order, while different channels deliver in parallel. Until start() is called deliveries run
+    # inline on the caller's thread, which is what benchmarks over fake sockets use. With a scheduler,
+    # each sender's queued fan-outs count against its scheduler.InboundScheduler delivery quota.
+    def __init__(self, workers=WORKERS, scheduler=None):
+        self.workers = workers
+        self.scheduler = scheduler
+        self.shards = [queue.SimpleQueue() for _ in range(workers)]
+        self.started = False
+        # Tasks delivered, one count per shard so each is only written by its own worker
+        self.delivered = [0] * workers
+
+    def start(self):
+        for i, shard in enumerate(self.shards):
+            thread = threading.Thread(target=self.run, args=(i,), name=f"delivery-{i}")
+            thread.daemon = True
+            thread.start()
+        self.started = True
+
+    # Send line to recipients (a snapshot of the channel's member list) except `exclude`. With silence,
+    # recipients who SILENCE exclude (the sender) are skipped. trace is the sender's tracing.Trace, if any.
+    # sender is the client whose command caused the fan-out.
+    def submit(self, channel, recipients, line, exclude=None, silence=False, trace=None, sender=None):
+        queued_at = trace.tracer.handoff(trace) if trace is not None else None
+        if not self.started:
+            self.deliver((recipients, line, exclude, silence, trace, queued_at))
+            return
+        if sender is not None and self.scheduler is not None:
+            self.scheduler.hold(sender)
+        else:
+            sender = None
+        self.shards[hash(channel) % self.workers].put((recipients, line, exclude, silence, trace, queued_at, sender))
+
+    def run(self, i):
+        shard = self.shards[i]
+        while True:
+            *task, sender = shard.get()
+            try:
+                self.deliver(task)
+            except Exception as e:
+                logging.error(f"Delivery failed: {e}")
+            if sender is not None:
+                self.scheduler.release(sender)
+            self.delivered[i] += 1
+
+    @staticmethod
+    def deliver(task):
+        recipients, line, exclude, silence, trace, queued_at = task
+        if trace is not None:
+            saved = trace.tracer.delivery_begin(trace, queued_at)
+        # The hostmask is only built if a recipient has a SILENCE list
+        hostmask = None
+        try:
+            for client in recipients:
+                if client is exclude:
+                    continue
+                if silence and client.silence is not None:
+                    if hostmask is None:
+                        hostmask = exclude.hostmask()
+                    if client.silence.matches(hostmask):
+                        continue
+                client.send_message(line)
+        finally:
+            if trace is not None:
+                trace.tracer.delivery_end(trace, saved)
+
+    # Wait until every shard has delivered what was queued before the call
+    def drain(self, timeout=None):
+        if not self.started:
+            return
+        done = [threading.Event() for _ in self.shards]
+        for shard, event in zip(self.shards, done):
+            shard.put(((DrainMarker(event),), "", None, False, None, None, None))
+        for event in done:
+            event.wait(timeout)
+
+    def snapshot(self):
+        backlog = sum(shard.qsize() for shard in self.shards)
+        delivered = sum(self.delivered)
+        return {"backlog": backlog, "queued": backlog + delivered, "delivered": delivered}
+
+
+class DrainMarker:
+    # Queued as the only recipient of a task, sets an event when its turn comes
+    __slots__ = ("event", "silence")
+
+    def __init__(self, event):
+        self.event = event
+        self.silence = None
+
+    def send_message(self, line):
+        self.event.set()
+
+
+class OutboundFlusher:
+    # Writes clients' buffered output (IRCClient.outbuf) once their sockets can take more. Sends never
+    # block: what a socket won't take straight away is buffered and the client is watched here, so a
+    # client that stops reading holds up nobody but itself. Idle while every client keeps up.
+    def __init__(self, poll_ms=FLUSH_POLL_MS):
+        self.poll_ms = poll_ms
+        self.lock = threading.Lock()
+        self.waiting = set()
+        self.wakeup = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="flusher")
+        thread.daemon = True
+        thread.start()
+
+    # Called with the client's send lock held, after it buffered output
+    def watch(self, client):
+        with self.lock:
+            self.waiting.add(client)
+        self.wakeup.set()
+
+    # Called with the client's send lock held, once its buffer is empty or dropped
+    def forget(self, client):
+        with self.lock:
+            self.waiting.discard(client)
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                clients = list(self.waiting)
+                if not clients:
+                    self.wakeup.clear()
+                    continue
+            poller = select.poll()
+            by_fd = {}
+            for client in clients:
+                fd = client.c_sock.fileno()
+                if fd == -1:
+                    # Closed, flush_output drops the buffer
+                    client.flush_output()
+                    continue
+                poller.register(fd, select.POLLOUT)
+                by_fd[fd] = client
+            for fd, _ in poller.poll(self.poll_ms):
+                try:
+                    by_fd[fd].flush_output()
+                except Exception as e:
+                    logging.error(f"Flushing output failed: {e}")
+
+    def snapshot(self):
+        with self.lock:
+            return {"waiting": len(self.waiting)}
@@ -0,0 +1,186 @@
+import re
+import time
+
+# RFC 1459 case mapping: []\~ are the upper case forms of {}|^
+CASEMAP = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~", "abcdefghijklmnopqrstuvwxyz{}|^")
+WILDCARDS = "*?"
+LABEL_SEPARATORS = re.compile(r"[.:]")
+# Match results remembered per index, dropped whenever the index changes
+CACHE_SIZE = 4096
+
+
+def irc_lower(text):
+    return text.translate(CASEMAP)
+
+
+# Complete a mask to nick!user@host form and case-fold it: "bob" -> "bob!*@*", "*@host" -> "*!*@host"
+def normalize_mask(mask):
+    mask = irc_lower(mask.strip())
+    if "!" not in mask and "@" not in mask:
+        mask += "!*@*"
+    elif "!" not in mask:
+        mask = "*!" + mask
+    elif "@" not in mask:
+        mask += "@*"
+    return mask
+
+
+def mask_to_regex(mask):
+    return "".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in mask)
+
+
+def has_wildcards(text):
+    return any(c in text for c in WILDCARDS)
+
+
+# Longest literal nick/user prefix used as an index key
+PREFIX_KEY_LENGTH = 8
+
+
+def literal_head(text):
+    ends = [text.find(c) for c in WILDCARDS if c in text]
+    return text[:min(ends)] if ends else text
+
+
+def literal_tail(text):
+    return text[max(text.rfind(c) for c in WILDCARDS) + 1:]
+
+
+# Index bucket for a normalized mask, chosen from the most selective literal part it has:
+# the exact host, the whole labels at the end or start of the host, or a nick or user prefix
+def bucket_for(mask):
+    nick, rest = mask.split("!", 1)
+    user, host = rest.rsplit("@", 1)
+    if not has_wildcards(host):
+        return ("host", host)
+    tail = literal_tail(host)
+    separator = LABEL_SEPARATORS.search(tail)
+    if separator:
+        return ("suffix", tail[separator.end():])
+    head = literal_head(host)
+    separators = list(LABEL_SEPARATORS.finditer(head))
+    if separators:
+        return ("prefix", head[:separators[-1].start()])
+    for field, text in (("nick", nick), ("user", user)):
+        head = literal_head(text)
+        if head:
+            return (field, head[:PREFIX_KEY_LENGTH])
+    return ("any",)
+
+
+# Buckets that may hold masks matching a case-folded nick!user@host, limited to the bucket kinds in use
+def candidate_buckets(hostmask, kinds):
+    nick, rest = hostmask.split("!", 1)
+    user, host = rest.rsplit("@", 1)
+    keys = [("host", host), ("any",)]
+    if "suffix" in kinds or "prefix" in kinds:
+        for separator in LABEL_SEPARATORS.finditer(host):
+            keys.append(("suffix", host[separator.end():]))
+            keys.append(("prefix", host[:separator.start()]))
+    if "nick" in kinds:
+        for length in range(1, min(len(nick), PREFIX_KEY_LENGTH) + 1):
+            keys.append(("nick", nick[:length]))
+    if "user" in kinds:
+        for length in range(1, min(len(user), PREFIX_KEY_LENGTH) + 1):
+            keys.append(("user", user[:length]))
+    return keys
+
+
+class MaskIndex:
+    # A set of nick!user@host masks (bans, exceptions, silence lists) compiled for fast matching.
+    # Masks without wildcards are a hash lookup. Wildcard masks are grouped by a literal part
+    # (see bucket_for) and each group is one precompiled regex, so a check only runs the few
+    # groups the hostmask can fall into.
+    def __init__(self):
+        self.entries = {}
+        self.exact = set()
+        self.buckets = {}
+        # Number of buckets of each kind, so lookups skip kinds that aren't used
+        self.kinds = {}
+        self.compiled = {}
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, mask):
+        return normalize_mask(mask) in self.entries
+
+    # (mask, set_by, set_at) for listing
+    def __iter__(self):
+        return iter([(mask, set_by, set_at) for mask, (set_by, set_at) in self.entries.items()])
+
+    # Returns the normalized mask, or None if it was already present
+    def add(self, mask, set_by="server", set_at=None):
+        mask = normalize_mask(mask)
+        if mask in self.entries:
+            return None
+        self.entries[mask] = (set_by, int(set_at if set_at is not None else time.time()))
+        if has_wildcards(mask):
+            key = bucket_for(mask)
+            if key not in self.buckets:
+                self.buckets[key] = set()
+                self.kinds[key[0]] = self.kinds.get(key[0], 0) + 1
+            self.buckets[key].add(mask)
+            self.compiled.pop(key, None)
+        else:
+            self.exact.add(mask)
+        self.cache.clear()
+        return mask
+
+    # Returns the normalized mask, or None if it wasn't present
+    def remove(self, mask):
+        mask = normalize_mask(mask)
+        if self.entries.pop(mask, None) is None:
+            return None
+        if has_wildcards(mask):
+            key = bucket_for(mask)
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(mask)
+                if not bucket:
+                    del self.buckets[key]
+                    self.kinds[key[0]] -= 1
+                    if not self.kinds[key[0]]:
+                        del self.kinds[key[0]]
+            self.compiled.pop(key, None)
+        else:
+            self.exact.discard(mask)
+        self.cache.clear()
+        return mask
+
+    def clear(self):
+        self.entries.clear()
+        self.exact.clear()
+        self.buckets.clear()
+        self.kinds.clear()
+        self.compiled.clear()
+        self.cache.clear()
+
+    def regex(self, key, bucket):
+        pattern = self.compiled.get(key)
+        if pattern is None:
+            # tuple() copies the set in one step, so a concurrent add can't break the iteration
+            pattern = re.compile("|".join(f"(?:{mask_to_regex(mask)})" for mask in tuple(bucket)), re.DOTALL)
+            self.compiled[key] = pattern
+        return pattern
+
+    # Whether nick!user@host matches any mask in the index
+    def matches(self, hostmask):
+        if not self.entries:
+            return False
+        hostmask = irc_lower(hostmask)
+        result = self.cache.get(hostmask)
+        if result is not None:
+            return result
+        result = hostmask in self.exact
+        if not result:
+            for key in candidate_buckets(hostmask, self.kinds):
+                bucket = self.buckets.get(key)
+                if bucket and self.regex(key, bucket).fullmatch(hostmask):
+                    result = True
+                    break
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+        self.cache[hostmask] = result
+        return result
@@ -0,0 +1,159 @@
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+PROFILE_DIR = "profiles"
+DEFAULT_DURATION = 30
+MAX_DURATION = 300
+SAMPLE_INTERVAL = 0.005
+# Frames kept per allocation by tracemalloc, more frames cost more while tracing
+TRACEMALLOC_FRAMES = 1
+
+
+class TimedLock:
+    # Wraps a lock and records how long acquire() waited while the profiler is running.
+    # When profiling is off this only adds one attribute check per acquire.
+    def __init__(self, name, profiler, lock=None):
+        self.name = name
+        self.profiler = profiler
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.profiler.active:
+            return self.lock.acquire(blocking, timeout)
+        # Uncontended: no wait to measure
+        if self.lock.acquire(False):
+            self.profiler.record_lock_wait(self.name, 0.0)
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.profiler.record_lock_wait(self.name, time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    # Called by logging after fork() on the locks it owns
+    def _at_fork_reinit(self):
+        self.lock._at_fork_reinit()
+
+
+class Profiler:
+    # On-demand profiling for a bounded window: samples the stacks of all threads, records lock waits
+    # on TimedLocks and diffs tracemalloc snapshots. Only one session runs at a time.
+    def __init__(self, out_dir=PROFILE_DIR):
+        self.out_dir = out_dir
+        self.active = False
+        self.session_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.lock_waits = {}
+        self.stop_event = threading.Event()
+
+    # Start profiling in the background. Returns the output path prefix, or None if a session is already running.
+    def start(self, duration=DEFAULT_DURATION, interval=SAMPLE_INTERVAL, memory=True):
+        if not self.session_lock.acquire(False):
+            return None
+        duration = max(1, min(duration, MAX_DURATION))
+        prefix = os.path.join(self.out_dir, time.strftime("profile-%Y%m%d-%H%M%S"))
+        self.stop_event.clear()
+        thread = threading.Thread(target=self._run, args=(prefix, duration, interval, memory), name="profiler")
+        thread.daemon = True
+        thread.start()
+        return prefix
+
+    def stop(self):
+        self.stop_event.set()
+
+    def record_lock_wait(self, name, waited):
+        with self.stats_lock:
+            stats = self.lock_waits.get(name)
+            if stats is None:
+                stats = self.lock_waits[name] = {"acquires": 0, "contended": 0, "wait_total": 0.0, "wait_max": 0.0}
+            stats["acquires"] += 1
+            if waited > 0:
+                stats["contended"] += 1
+                stats["wait_total"] += waited
+                stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def _run(self, prefix, duration, interval, memory):
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            tracing = memory and not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            before = tracemalloc.take_snapshot() if tracing else None
+            with self.stats_lock:
+                self.lock_waits = {}
+            self.active = True
+            logging.warning(f"Profiling started for {duration}s, writing {prefix}.*")
+
+            stacks, samples, elapsed = self._sample(duration, interval)
+
+            self.active = False
+            after = tracemalloc.take_snapshot() if tracing else None
+            if tracing:
+                tracemalloc.stop()
+            self._write(prefix, stacks, samples, elapsed, before, after)
+            logging.warning(f"Profiling finished, {samples} samples written to {prefix}.*")
+        except Exception as e:
+            logging.error(f"Profiling failed: {e}")
+        finally:
+            self.active = False
+            self.session_lock.release()
+
+    # Collect stacks of every other thread every interval seconds
+    def _sample(self, duration, interval):
+        own = threading.get_ident()
+        stacks = collections.Counter()
+        samples = 0
+        start = time.monotonic()
+        deadline = start + duration
+        while time.monotonic() < deadline and not self.stop_event.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stacks[self._fold(names.get(ident, str(ident)), frame)] += 1
+            samples += 1
+        return stacks, samples, time.monotonic() - start
+
+    # Collapsed stack, root first: "thread;func (file:line);..."
+    @staticmethod
+    def _fold(thread_name, frame):
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        parts.append(thread_name.replace(";", ":"))
+        return ";".join(reversed(parts))
+
+    # <prefix>.folded: collapsed stacks for flamegraph.pl or speedscope
+    # <prefix>.locks.json: per lock acquire counts and wait times
+    # <prefix>.tracemalloc: snapshot for tracemalloc.Snapshot.load, <prefix>.memory.txt: top allocation growth
+    def _write(self, prefix, stacks, samples, elapsed, before, after):
+        with open(prefix + ".folded", "w") as out:
+            for stack, count in stacks.most_common():
+                out.write(f"{stack} {count}\n")
+        with self.stats_lock:
+            lock_waits = dict(self.lock_waits)
+        with open(prefix + ".locks.json", "w") as out:
+            json.dump({"duration": elapsed, "samples": samples, "locks": lock_waits}, out, indent=2)
+        if after is not None:
+            after.dump(prefix + ".tracemalloc")
+            with open(prefix + ".memory.txt", "w") as out:
+                for stat in after.compare_to(before, "lineno")[:50]:
+                    out.write(f"{stat}\n")
@@ -0,0 +1,187 @@
+import argparse
+import difflib
+import json
+import socket
+import threading
+import time
+
+from capture import CLOSE, IN, OPEN, OUT, read_capture
+
+# Seconds to keep reading responses after a connection's last recorded line
+SETTLE_TIME = 2.0
+
+
+class RecordedConnection:
+    def __init__(self, conn_id):
+        self.conn_id = conn_id
+        self.opened = 0.0
+        self.closed = None
+        self.inbound = []   # (timestamp, line)
+        self.outbound = b""
+
+
+# Group a capture file by connection
+def load_connections(path):
+    connections = {}
+    for timestamp, conn_id, kind, payload in read_capture(path):
+        conn = connections.get(conn_id)
+        if conn is None:
+            conn = connections[conn_id] = RecordedConnection(conn_id)
+            conn.opened = timestamp
+        if kind == OPEN:
+            conn.opened = timestamp
+        elif kind == IN:
+            conn.inbound.append((timestamp, payload))
+        elif kind == OUT:
+            conn.outbound += payload
+        elif kind == CLOSE:
+            conn.closed = timestamp
+    return sorted(connections.values(), key=lambda c: c.opened)
+
+
+class ReplayConnection:
+    # Replays one recorded connection on its own socket and collects what the server sends back
+    def __init__(self, recorded, host, port, speed, start):
+        self.recorded = recorded
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.start = start
+        self.received = b""
+        self.sent = 0
+        self.latencies = []
+        self.error = None
+        self.lock = threading.Lock()
+        self.awaiting = None
+
+    # Wall clock time at which something recorded at timestamp should happen
+    def due(self, timestamp):
+        if not self.speed:
+            return 0
+        return self.start + timestamp / self.speed
+
+    def wait_until(self, when):
+        delay = when - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def run(self):
+        try:
+            self.wait_until(self.due(self.recorded.opened))
+            sock = socket.create_connection((self.host, self.port))
+        except OSError as e:
+            self.error = repr(e)
+            return
+        reader = threading.Thread(target=self.read, args=(sock,), daemon=True)
+        reader.start()
+        try:
+            for timestamp, line in self.recorded.inbound:
+                self.wait_until(self.due(timestamp))
+                with self.lock:
+                    if self.awaiting is None:
+                        self.awaiting = time.monotonic()
+                sock.sendall(line + b"\r\n")
+                self.sent += 1
+            if self.recorded.closed is not None:
+                self.wait_until(self.due(self.recorded.closed))
+            time.sleep(SETTLE_TIME)
+        except OSError as e:
+            self.error = repr(e)
+        finally:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+            reader.join(1)
+
+    # Latency: time from the first line sent since the last response to the next response bytes
+    def read(self, sock):
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            now = time.monotonic()
+            with self.lock:
+                if self.awaiting is not None:
+                    self.latencies.append(now - self.awaiting)
+                    self.awaiting = None
+            self.received += data
+
+    def diff(self, limit):
+        expected = self.recorded.outbound.decode("utf-8", errors="replace").splitlines()
+        actual = self.received.decode("utf-8", errors="replace").splitlines()
+        if expected == actual:
+            return []
+        lines = difflib.unified_diff(expected, actual, f"recorded/{self.recorded.conn_id}", f"replayed/{self.recorded.conn_id}", lineterm="")
+        return list(lines)[:limit]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def replay(path, host, port, speed, diff_limit=20):
+    recorded = load_connections(path)
+    start = time.monotonic() + 0.1
+    replays = [ReplayConnection(conn, host, port, speed, start) for conn in recorded]
+    threads = [threading.Thread(target=r.run, daemon=True) for r in replays]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies = [lat for r in replays for lat in r.latencies]
+    sent = sum(r.sent for r in replays)
+    diffs = {r.recorded.conn_id: r.diff(diff_limit) for r in replays}
+    return {
+        "connections": len(replays),
+        "lines_sent": sent,
+        "bytes_received": sum(len(r.received) for r in replays),
+        "elapsed": round(elapsed, 3),
+        "lines_per_second": round(sent / elapsed, 1) if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+            "p99": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+            "max": round(max(latencies) * 1000, 3) if latencies else None,
+        },
+        "errors": {r.recorded.conn_id: r.error for r in replays if r.error},
+        "mismatched_connections": sorted(conn_id for conn_id, lines in diffs.items() if lines),
+        "diffs": {conn_id: lines for conn_id, lines in diffs.items() if lines},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a server traffic capture and compare the responses")
+    parser.add_argument("capture", help="File written by server.py --capture")
+    parser.add_argument("--host", default="::1")
+    parser.add_argument("--port", type=int, default=6667)
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 1 for real time, 10 for 10x, 0 for as fast as possible")
+    parser.add_argument("--diff-lines", type=int, default=20, help="Diff lines shown per mismatched connection")
+    parser.add_argument("--json", action="store_true", help="Print the full report as JSON")
+    args = parser.parse_args()
+
+    report = replay(args.capture, args.host, args.port, args.speed, args.diff_lines)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['connections']} connections, {report['lines_sent']} lines in {report['elapsed']}s ({report['lines_per_second']} lines/s)")
+    latency = report["latency_ms"]
+    print(f"Response latency ms: p50 {latency['p50']}, p99 {latency['p99']}, max {latency['max']}")
+    for conn_id, error in report["errors"].items():
+        print(f"Connection {conn_id} failed: {error}")
+    if not report["mismatched_connections"]:
+        print("All responses match the capture")
+    for conn_id, lines in report["diffs"].items():
+        print("\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import random
+
+# RFC 1459 case mapping: []\~ are the upper case forms of {}|^
+CASEMAP = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~", "abcdefghijklmnopqrstuvwxyz{}|^")
+
+# NAMES entries may carry a membership prefix
+MEMBER_PREFIXES = "~&@%+"
+
+
+def ircLower(name):
+    return name.translate(CASEMAP)
+
+
+class Roster:
+    # Users of one channel. Nicks are kept in a list for O(1) random picks and indexed
+    # by their case-folded form so add, remove and lookups are O(1) as well.
+    def __init__(self, nicks=()):
+        self.nicks = []
+        self.index = {}
+        for nick in nicks:
+            self.add(nick)
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def __iter__(self):
+        return iter(list(self.nicks))
+
+    def __contains__(self, nick):
+        return ircLower(nick) in self.index
+
+    def add(self, nick):
+        key = ircLower(nick)
+        if key in self.index:
+            # Same user, possibly different case: keep the latest spelling
+            self.nicks[self.index[key]] = nick
+            return False
+        self.index[key] = len(self.nicks)
+        self.nicks.append(nick)
+        return True
+
+    # Swap the last nick into the removed slot so removal doesn't shift the list
+    def remove(self, nick):
+        key = ircLower(nick)
+        pos = self.index.pop(key, None)
+        if pos is None:
+            return False
+        last = self.nicks.pop()
+        if pos < len(self.nicks):
+            self.nicks[pos] = last
+            self.index[ircLower(last)] = pos
+        return True
+
+    def rename(self, old, new):
+        if self.remove(old):
+            self.add(new)
+            return True
+        return False
+
+    # Random nick that isn't in exclude (case-folded names); None if there is nobody to pick
+    def random(self, exclude=()):
+        excluded = sum(1 for key in exclude if key in self.index)
+        if len(self.nicks) <= excluded:
+            return None
+        while True:
+            nick = random.choice(self.nicks)
+            if ircLower(nick) not in exclude:
+                return nick
+
+
+class Rosters:
+    # Per-channel rosters kept up to date from JOIN/PART/QUIT/NICK/KICK and NAMES replies
+    def __init__(self):
+        self.channels = {}
+        # NAMES replies can span several 353 lines, they are collected until 366
+        self.pending = {}
+
+    def get(self, channel):
+        return self.channels.get(ircLower(channel))
+
+    def ensure(self, channel):
+        key = ircLower(channel)
+        if key not in self.channels:
+            self.channels[key] = Roster()
+        return self.channels[key]
+
+    def drop(self, channel):
+        self.channels.pop(ircLower(channel), None)
+        self.pending.pop(ircLower(channel), None)
+
+    def join(self, channel, nick):
+        self.ensure(channel).add(nick)
+
+    def part(self, channel, nick):
+        roster = self.get(channel)
+        if roster is not None:
+            roster.remove(nick)
+
+    def quit(self, nick):
+        for roster in self.channels.values():
+            roster.remove(nick)
+
+    def nick(self, old, new):
+        for roster in self.channels.values():
+            roster.rename(old, new)
+
+    def names(self, channel, names):
+        pending = self.pending.setdefault(ircLower(channel), Roster())
+        for name in names:
+            name = name.lstrip(MEMBER_PREFIXES)
+            if name:
+                pending.add(name.split("!", 1)[0])
+
+    # RPL_ENDOFNAMES: the collected reply replaces the channel's roster
+    def endOfNames(self, channel):
+        key = ircLower(channel)
+        pending = self.pending.pop(key, None)
+        if pending is not None:
+            self.channels[key] = pending
@@ -0,0 +1,143 @@
+import collections
+import logging
+import threading
+
+# Per round, a connection gets at most this many lines or bytes processed before the next ready one is served
+LINE_QUOTA = 8
+BYTE_QUOTA = 4096
+# A connection's reader stops reading once this many lines are waiting, so a flooder is held back by TCP
+MAX_PENDING = 256
+# A connection with this many fan-outs waiting in the delivery pool isn't run until they are delivered,
+# so a flooder can't fill the pool ahead of everyone else
+DELIVERY_QUOTA = 16
+WORKERS = 4
+
+
+class InboundScheduler:
+    # Processes received lines for all connections, round robin. Client threads only read and split
+    # lines and hand them to submit(); workers take one ready connection at a time, run up to a quota of
+    # its lines and put it back at the end of the ready queue if it has more. A connection is only ever
+    # on one worker, so its lines stay in order. A connection whose fan-outs are backed up in the
+    # delivery pool is parked until they drain, see hold() and release().
+    def __init__(self, workers=WORKERS, line_quota=LINE_QUOTA, byte_quota=BYTE_QUOTA, max_pending=MAX_PENDING,
+                 delivery_quota=DELIVERY_QUOTA):
+        self.workers = workers
+        self.line_quota = line_quota
+        self.byte_quota = byte_quota
+        self.max_pending = max_pending
+        self.delivery_quota = delivery_quota
+        self.lock = threading.Lock()
+        # Signalled when a connection becomes ready, and when a full inbox has room again
+        self.work = threading.Condition(self.lock)
+        self.space = threading.Condition(self.lock)
+        self.ready = collections.deque()
+        self.rounds = 0
+        self.deferred = 0
+        self.parked = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f"scheduler-{i}")
+            thread.daemon = True
+            thread.start()
+
+    # Queue a line from client for processing, with its tracing.Trace if it is sampled. None marks the
+    # end of the connection and runs client.finish_connection() after everything received before it.
+    def submit(self, client, line, trace=None):
+        with self.lock:
+            if client.inbox is None:
+                client.inbox = collections.deque()
+            client.inbox.append((line, trace))
+            if not client.scheduled:
+                client.scheduled = True
+                self.ready.append(client)
+                self.work.notify()
+
+    # The delivery pool queued a fan-out sent by client
+    def hold(self, client):
+        with self.lock:
+            client.deliveries += 1
+
+    # The delivery pool delivered one of client's fan-outs. A parked client is run again once half its
+    # quota has drained.
+    def release(self, client):
+        with self.lock:
+            client.deliveries -= 1
+            if client.parked and client.deliveries <= self.delivery_quota // 2:
+                client.parked = False
+                self.ready.append(client)
+                self.work.notify()
+
+    # Block the client's reader while it has too many lines waiting
+    def wait_for_space(self, client):
+        with self.lock:
+            while client.inbox is not None and len(client.inbox) >= self.max_pending:
+                self.space.wait()
+
+    # Up to a quota of lines from the client's inbox, at least one
+    def take_batch(self, client):
+        inbox = client.inbox
+        was_full = len(inbox) >= self.max_pending
+        batch = [inbox.popleft()]
+        size = len(batch[0][0] or "")
+        while inbox and len(batch) < self.line_quota and size < self.byte_quota:
+            item = inbox.popleft()
+            batch.append(item)
+            if item[0] is not None:
+                size += len(item[0])
+        if inbox:
+            self.deferred += 1
+        else:
+            # An idle connection doesn't keep an empty deque around
+            client.inbox = None
+        if was_full:
+            self.space.notify_all()
+        return batch
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.ready:
+                    self.work.wait()
+                client = self.ready.popleft()
+                # Still scheduled, so submit() won't queue it again; release() puts it back
+                if client.deliveries >= self.delivery_quota:
+                    client.parked = True
+                    self.parked += 1
+                    continue
+                batch = self.take_batch(client)
+                self.rounds += 1
+            for line, trace in batch:
+                if trace is None:
+                    self.process(client, line)
+                    continue
+                trace.tracer.begin(trace)
+                try:
+                    self.process(client, line)
+                finally:
+                    trace.tracer.end(trace)
+            with self.lock:
+                if client.inbox:
+                    self.ready.append(client)
+                    self.work.notify()
+                else:
+                    client.scheduled = False
+
+    def process(self, client, line):
+        try:
+            if line is None:
+                client.finish_connection()
+            elif not client.disconnected:
+                client.process_message(line)
+        except Exception as e:
+            if str(e) == "Client disconnected":
+                logging.info(f"Client {client.nickname} has disconnected.")
+            else:
+                logging.error(f"Error in client: {e}")
+            # A failing command drops the connection, as it did when clients processed their own lines
+            if client.is_socket_open():
+                client.notify_disconnect()
+
+    def snapshot(self):
+        with self.lock:
+            return {"ready": len(self.ready), "rounds": self.rounds, "deferred": self.deferred, "parked": self.parked}
@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import time
+
+# Priorities, lowest number goes first
+URGENT = 0  # PONG and registration, never delayed by pacing or dropped
+NORMAL = 1  # JOIN, NICK and other protocol lines, never dropped so the bot's state matches the server's
+LOW = 2     # Command replies, merged or dropped when the queue backs up
+
+# Defaults: a burst of 5 lines, then one line per second
+SEND_RATE = 1.0
+SEND_BURST = 5
+MAX_DEPTH = 50
+# Low priority replies older than this are no longer worth sending
+MAX_AGE = 30.0
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    # Seconds until a token is available
+    def delay(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    # Urgent lines may take the bucket below zero, later lines then wait longer
+    def consume(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class QueuedLine:
+    __slots__ = ("data", "key", "onSent", "queuedAt")
+
+    def __init__(self, data, key, onSent, queuedAt):
+        self.data = data
+        self.key = key
+        self.onSent = onSent
+        self.queuedAt = queuedAt
+
+
+class SendQueue:
+    # Paced outbound queue for one connection. Must only be used from the event loop thread.
+    def __init__(self, rate=SEND_RATE, burst=SEND_BURST, maxDepth=MAX_DEPTH, maxAge=MAX_AGE):
+        self.bucket = TokenBucket(rate, burst)
+        self.maxDepth = maxDepth
+        self.maxAge = maxAge
+        self.queues = (collections.deque(), collections.deque(), collections.deque())
+        # Merge key -> queued line, so a newer reply replaces a stale one still waiting
+        self.pending = {}
+        # Created in run() so the queue can be built before the event loop exists
+        self.wakeup = None
+        self.sent = 0
+        self.dropped = 0
+        self.merged = 0
+        self.maxSeen = 0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def put(self, data, priority=NORMAL, key=None, onSent=None):
+        now = time.monotonic()
+        if key is not None and key in self.pending:
+            entry = self.pending[key]
+            entry.data = data
+            entry.onSent = onSent
+            self.merged += 1
+            return
+        entry = QueuedLine(data, key, onSent, now)
+        self.queues[priority].append(entry)
+        if key is not None:
+            self.pending[key] = entry
+        if len(self) > self.maxDepth:
+            self.shed()
+        self.maxSeen = max(self.maxSeen, len(self))
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    # Drop the oldest low priority line. With none queued the queue may grow past maxDepth: protocol
+    # lines change state on the server and are never dropped.
+    def shed(self):
+        low = self.queues[LOW]
+        if low:
+            self.forget(low.popleft())
+            self.dropped += 1
+
+    def forget(self, entry):
+        if entry.key is not None and self.pending.get(entry.key) is entry:
+            del self.pending[entry.key]
+
+    # Next line to send and its priority, discarding stale low priority replies
+    def peek(self, now):
+        low = self.queues[LOW]
+        while low and now - low[0].queuedAt > self.maxAge:
+            self.forget(low.popleft())
+            self.dropped += 1
+        for priority, queue in enumerate(self.queues):
+            if queue:
+                return queue[0], priority
+        return None, None
+
+    def clear(self):
+        for queue in self.queues:
+            queue.clear()
+        self.pending.clear()
+
+    async def run(self, writer):
+        self.wakeup = asyncio.Event()
+        while True:
+            now = time.monotonic()
+            entry, priority = self.peek(now)
+            if entry is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if priority != URGENT:
+                delay = self.bucket.delay(now)
+                if delay > 0:
+                    # Wake early if something more urgent is queued meanwhile
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+            self.queues[priority].popleft()
+            self.forget(entry)
+            self.bucket.consume(now)
+            writer.write(entry.data)
+            self.sent += 1
+            if entry.onSent is not None:
+                entry.onSent()
+            await writer.drain()
+
+    def snapshot(self):
+        return {
+            "depth": len(self),
+            "peakDepth": self.maxSeen,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "merged": self.merged,
+        }
@@ -1,28 +1,86 @@
 from logging import shutdown
+import argparse
+import hmac
+import select
+import signal
 import socket
+import sys
 import threading
 import time
 import logging
+from types import MappingProxyType
 logging.basicConfig(level=logging.INFO)
 
+from admin import AdminServer
+from capture import CLOSE, IN, OUT, TrafficCapture
+from chanlog import ChannelLog
+from fanout import DeliveryPool, OutboundFlusher
+from masks import MaskIndex, irc_lower
+from profiling import DEFAULT_DURATION, Profiler, TimedLock
+from scheduler import InboundScheduler
+from sendqueue import TokenBucket
+from tracing import DEFAULT_SAMPLE_RATE, Tracer
+
 NICKNAME_MAX_LENGTH = 15
 ALLOWED_CHARACTERS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-[]\\`^{}")
 STARTING_CHARACTERS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+# Client threads mostly sit in recv(), they don't need the default 8 MiB stack reservation
+THREAD_STACK_SIZE = 128 * 1024
+# Shared read-only stand-in for the channels of a client that is in none
+NO_CHANNELS = MappingProxyType({})
+# Channel modes: list modes (b, e), modes with a parameter (k, l, o, v) and plain flags (m, n)
+LIST_MODES = {
+    "b": ("bans", "367", "368", "End of channel ban list"),
+    "e": ("excepts", "348", "349", "End of channel exception list"),
+}
+PARAM_MODES = set("klov")
+FLAG_MODES = set("mn")
+DEFAULT_CHANNEL_MODES = "n"
+MAX_LIST_ENTRIES = 10000
+# Most nicknames one client may MONITOR
+MONITOR_LIMIT = 100
+# Most masks in one client's SILENCE list
+SILENCE_LIMIT = 32
+# Most bytes of output buffered for a client that isn't reading before it is disconnected
+SENDQ_LIMIT = 1024 * 1024
 
 
 class IRCServer:
     # Default server configuration
     HOST = "::"
     PORT = 6667
+    # Seconds an IP must wait to reconnect after timing out
+    RECONNECT_COOLDOWN = 8
+    # Most simultaneous connections, 0 for no limit
+    MAX_CLIENTS = 0
 
      # Initialize the server with default attributes
     def __init__(self):
         self.s_sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         self.clients = []
         self.channels = {}
-        self.c_lock = threading.Lock()
+        self.profiler = Profiler()
+        self.c_lock = TimedLock("c_lock", self.profiler)
         self.reg_users = set()
         self.disconn_times = {}
+        # OPER name -> password. Only clients that OPER successfully get user mode +o.
+        self.operators = {}
+        # Optional TrafficCapture recording every connection's traffic, see replay.py
+        self.capture = None
+        # Who is online and who watches whom, for MONITOR and ISON
+        self.presence = PresenceIndex()
+        # Optional AdminServer on a Unix socket, see admin.py
+        self.admin = None
+        # Optional ChannelLog persisting channel traffic, see chanlog.py
+        self.chanlog = None
+        # Optional Tracer timing sampled messages from recv to each recipient's socket, see tracing.py
+        self.tracer = None
+        # Runs received lines for all clients round robin, see scheduler.py
+        self.scheduler = InboundScheduler()
+        # Sends channel fan-out off the sender's thread, in order per channel, see fanout.py
+        self.delivery = DeliveryPool(scheduler=self.scheduler)
+        # Writes output that clients' sockets couldn't take straight away, see fanout.py
+        self.flusher = OutboundFlusher()
 
     # Bind the server to the specified host and port, then start listening
     def bind_and_listen(self):
@@ -30,12 +88,25 @@ class IRCServer:
         self.s_sock.listen(5)
         print(f"Listening on {self.HOST} : {self.PORT}")
 
+    # Read "name password" lines from path into the OPER credentials
+    def load_operators(self, path):
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and not parts[0].startswith("#"):
+                    self.operators[parts[0]] = parts[1]
+
     # Retrieve an existing channel or create a new one
     def get_or_create_channel(self, ch_name):
         if ch_name not in self.channels:
             self.channels[ch_name] = Channel(ch_name)
         return self.channels[ch_name]
 
+    # Record a line sent to a channel, if channel logging is on. Only queues it, never waits on disk.
+    def log_channel(self, ch_name, line):
+        if self.chanlog:
+            self.chanlog.append(ch_name, line)
+
     # Regularly remove IPs that have passed their cooldown period
     def cleanup_disconnects(self):
         while True:
@@ -55,16 +126,23 @@ class IRCServer:
         c_sock, c_addr = self.s_sock.accept()
         print(f"Accepted connection from {c_addr[0]} : {c_addr[1]}")
         ip = c_addr[0]
-        if ip in self.disconn_times and time.time() - self.disconn_times[ip] < 8:
+        if ip in self.disconn_times and time.time() - self.disconn_times[ip] < self.RECONNECT_COOLDOWN:
             print(f"Connection attempt from {ip} but it's on cooldown.")
             # Inform the client of the cooldown
             c_sock.send(b"Connection denied: Your IP is on a cooldown.\n")
             c_sock.close()
             return None
+        if self.MAX_CLIENTS and len(self.clients) >= self.MAX_CLIENTS:
+            print(f"Connection attempt from {ip} but the server is full.")
+            c_sock.send(b"Connection denied: The server is full.\n")
+            c_sock.close()
+            return None
         return c_sock
 
     # Handle an individual client's activities
     def handle_ind_client(self, c_sock):
+        # Sends must never wait on a client that stops reading, see ClientConnection.write
+        c_sock.setblocking(False)
         client = IRCClient(c_sock, self)
         self.c_lock.acquire()
         try:
@@ -75,15 +153,65 @@ class IRCServer:
 
     # Shut down the server and close all connections
     def shutdown(self):
-        self.broadcast_message(":server NOTICE :Server is shutting down\r\n")
-        time.sleep(5)
-        for client in self.clients:
-            client.c_sock.close()
-        self.s_sock.close()
+        with self.c_lock:
+            clients = list(self.clients)
+        try:
+            for client in clients:
+                client.send_message(":server NOTICE :Server is shutting down\r\n")
+            time.sleep(5)
+            self.delivery.drain(timeout=5)
+            for client in clients:
+                client.c_sock.close()
+            self.s_sock.close()
+        finally:
+            # Flush and close the capture, admin socket and channel log whatever happened above
+            if self.capture:
+                self.capture.close()
+            if self.admin:
+                self.admin.close()
+            if self.chanlog:
+                self.chanlog.close()
         print("Server has been shut down.")
 
+    # Limits the admin socket may change at runtime: name -> (owner, attribute)
+    def tunables(self):
+        module = sys.modules[__name__]
+        return {
+            "client_timeout": (IRCClient, "TIMEOUT"),
+            "rate_limit": (IRCClient, "RATE_LIMIT"),
+            "rate_burst": (IRCClient, "RATE_BURST"),
+            "reconnect_cooldown": (IRCServer, "RECONNECT_COOLDOWN"),
+            "max_clients": (IRCServer, "MAX_CLIENTS"),
+            "monitor_limit": (module, "MONITOR_LIMIT"),
+            "silence_limit": (module, "SILENCE_LIMIT"),
+            "sendq_limit": (module, "SENDQ_LIMIT"),
+            "max_list_entries": (module, "MAX_LIST_ENTRIES"),
+            "nickname_max_length": (module, "NICKNAME_MAX_LENGTH"),
+            "line_quota": (self.scheduler, "line_quota"),
+            "byte_quota": (self.scheduler, "byte_quota"),
+            "max_pending": (self.scheduler, "max_pending"),
+            "delivery_quota": (self.scheduler, "delivery_quota"),
+        }
+
+    # Time spent waiting on the logging handler locks shows up in profiles next to c_lock
+    def instrument_logging(self):
+        for handler in logging.getLogger().handlers:
+            if handler.lock is not None and not isinstance(handler.lock, TimedLock):
+                handler.lock = TimedLock(f"logging:{type(handler).__name__}", self.profiler, handler.lock)
+
+    # SIGUSR1 starts a profiling session with the default duration
+    def install_profile_signal(self):
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.profiler.start(DEFAULT_DURATION))
+
     # Start the server and manage client connections
     def start(self):
+        threading.stack_size(THREAD_STACK_SIZE)
+        self.instrument_logging()
+        self.install_profile_signal()
+        self.scheduler.start()
+        self.delivery.start()
+        self.flusher.start()
         # Start the cleanup thread
         cleanup_thread = threading.Thread(target=self.cleanup_disconnects)
         cleanup_thread.daemon = True
@@ -118,6 +246,8 @@ class IRCServer:
 
 
 class ClientConnection:
+    __slots__ = ()
+
     # Send a message to the client. Handles errors and logs accordingly
     def send_message(self, message):
         if not message:
@@ -126,16 +256,77 @@ class ClientConnection:
 
         try:
             logging.info(f"\nSending:\n{message}")
-            self.c_sock.send(message.encode("utf-8"))
+            data = message.encode("utf-8")
+            if self.server.capture:
+                self.server.capture.record(self.conn_id, OUT, data)
+            tracer = self.server.tracer
+            trace = tracer.current() if tracer is not None else None
+            if trace is None:
+                self.write(data)
+            else:
+                started = time.perf_counter()
+                self.write(data)
+                tracer.record_send(trace, started)
         except (socket.error, BrokenPipeError) as e:
             logging.error(f"An error occurred while sending the message: {e}")
         except Exception as e:
             logging.error(f"Unexpected error: {e}")
 
+    # Send data without blocking. What the socket won't take now is kept in outbuf and written by the
+    # server's flusher when the client reads again, so delivery and scheduler workers never wait on a
+    # slow reader. A client with more than SENDQ_LIMIT bytes waiting is disconnected.
+    def write(self, data):
+        with self.send_lock:
+            if self.outbuf is None:
+                try:
+                    sent = self.c_sock.send(data)
+                except BlockingIOError:
+                    sent = 0
+                if sent < len(data):
+                    self.outbuf = bytearray(data[sent:])
+                    self.server.flusher.watch(self)
+                return
+            if len(self.outbuf) + len(data) <= SENDQ_LIMIT:
+                self.outbuf += data
+                return
+            self.outbuf = None
+            self.server.flusher.forget(self)
+        self.drop_slow_consumer()
+
+    # Called by the flusher when the socket can take more of outbuf
+    def flush_output(self):
+        with self.send_lock:
+            if self.outbuf:
+                try:
+                    sent = self.c_sock.send(self.outbuf)
+                except BlockingIOError:
+                    return
+                except socket.error as e:
+                    logging.error(f"An error occurred while flushing output: {e}")
+                    sent = len(self.outbuf)
+                del self.outbuf[:sent]
+            if not self.outbuf:
+                self.outbuf = None
+                self.server.flusher.forget(self)
+
+    # Disconnect a client whose unsent output passed SENDQ_LIMIT. Its reader wakes up and quits its
+    # channels like a kill from the admin socket.
+    def drop_slow_consumer(self):
+        logging.warning(f"Disconnecting {self.nickname}: more than {SENDQ_LIMIT} bytes of output waiting")
+        self.killed = "SendQ exceeded"
+        try:
+            self.c_sock.shutdown(socket.SHUT_RDWR)
+        except socket.error as e:
+            logging.error(f"Socket error during shutdown: {e}")
+
     # Notify the server about a client's disconnection and handle cleanup
     def notify_disconnect(self):
         if self.nickname and self.nickname in self.server.reg_users:
             self.server.reg_users.remove(self.nickname)
+        # Tell MONITOR watchers this user is gone and drop the client's own watches
+        if self.is_registered:
+            self.server.presence.went_offline(self, self.nickname)
+        self.server.presence.unwatch_all(self)
         self.server.c_lock.acquire()
         try:
             if self in self.server.clients:
@@ -154,24 +345,43 @@ class ClientConnection:
             logging.warning("Attempt to shutdown a non-socket or already closed socket.")
     # Main handler for the client. Processes messages and handles errors
     def handle_client(self):
+        capture = self.server.capture
+        if capture:
+            try:
+                peer = self.c_sock.getpeername()[0]
+            except socket.error:
+                peer = ""
+            self.conn_id = capture.new_connection(peer)
         try:
+            # The socket is non-blocking for the sake of senders, so the reader waits for input here
+            poller = select.poll()
+            poller.register(self.c_sock, select.POLLIN)
             while not self.disconnected:  # Check if the client is disconnected
                 try:
                     if not self.is_socket_open():
                         logging.error("Socket is already closed.")
                         return
 
-                    self.c_sock.settimeout(IRCClient.TIMEOUT)
+                    if not poller.poll(IRCClient.TIMEOUT * 1000):
+                        raise socket.timeout
+                except socket.timeout:
+                    raise
                 except socket.error as e:
-                    logging.error(f"Socket error (setting timeout): {e}")
+                    logging.error(f"Socket error (waiting for input): {e}")
                     return  
                 except Exception as e:
-                    logging.error(f"Unexpected error in client (setting timeout): {e}")
+                    logging.error(f"Unexpected error in client (waiting for input): {e}")
                     return           
 
-                data = self.c_sock.recv(4096)
+                try:
+                    data = self.c_sock.recv(4096)
+                except BlockingIOError:
+                    continue
                 if not data:
                     break
+                self.last_activity = time.monotonic()
+                tracer = self.server.tracer
+                received = time.perf_counter() if tracer is not None else None
                 
                 try:
                     self.buffer += data.decode("utf-8")
@@ -179,12 +389,17 @@ class ClientConnection:
                     logging.error(f"Unicode decode error: {ue}")
                     continue                    
 
+                # Lines are processed by the server's scheduler, in turn with other clients
                 while "\r\n" in self.buffer:
                     message, self.buffer = self.buffer.split("\r\n", 1)
+                    if capture:
+                        capture.record(self.conn_id, IN, message.encode("utf-8"))
                     message = message.strip()
                     logging.info(f"Received: {repr(message)}")
-                    self.process_message(message)
-                self.process_buffered_messages()
+                    self.pace_input()
+                    self.server.scheduler.submit(self, message, tracer.ingress(received) if tracer is not None else None)
+                # Stop reading while too much is waiting, TCP then slows the client down
+                self.server.scheduler.wait_for_space(self)
 
         except socket.timeout:
             logging.warning(
@@ -200,8 +415,41 @@ class ClientConnection:
             else:
                 logging.error(f"Error in client: {e}")
         finally:
-            if self.is_socket_open():
-                self.notify_disconnect()
+            # Cleanup runs after the lines already received
+            self.server.scheduler.submit(self, None)
+
+    # Called by the scheduler once the connection has ended and its remaining lines are processed
+    def finish_connection(self):
+        if self.server.capture:
+            self.server.capture.record(self.conn_id, CLOSE, b"")
+        # Killed from the admin socket: leave channels the way a QUIT does
+        if self.killed is not None and not self.disconnected:
+            self.handle_quit(f"QUIT :Killed ({self.killed})")
+        if self.is_socket_open():
+            self.notify_disconnect()
+
+    # Hold back a client that sends faster than its throttle or the default rate limit allows
+    def pace_input(self):
+        bucket = self.throttle
+        if bucket is None:
+            if not IRCClient.RATE_LIMIT:
+                return
+            bucket = self.throttle = TokenBucket(IRCClient.RATE_LIMIT, IRCClient.RATE_BURST)
+        delay = bucket.delay(time.monotonic())
+        if delay > 0:
+            time.sleep(delay)
+        bucket.consume(time.monotonic())
+
+    # Disconnect the client from another thread. Closing the read side wakes the client's own
+    # thread, which ends the connection and has it quit its channels.
+    def kill(self, reason):
+        self.killed = reason
+        self.send_message(f"ERROR :Closing link: {self.nickname} (Killed ({reason}))\r\n")
+        try:
+            self.c_sock.shutdown(socket.SHUT_RD)
+        except socket.error as e:
+            logging.error(f"Socket error during kill: {e}")
+
     # Check if the client socket is open
     def is_socket_open(self):
         try:
@@ -236,15 +484,10 @@ class ClientConnection:
             
             self.notify_disconnect()
 
-    # Process any buffered messages from the client.
-    def process_buffered_messages(self):
-        while "\r\n" in self.buffer:
-            message, self.buffer = self.buffer.split("\r\n", 1)
-            logging.info(f"Received: {repr(message)}")
-            self.process_message(message.strip())
-
 
 class ClientRegistration:
+    __slots__ = ()
+
     def register_client(self):
         logging.info(f"Registering client with nickname: {self.nickname}")
 
@@ -255,6 +498,8 @@ class ClientRegistration:
             self.send_message(
                 f":server 001 {self.nickname} :Welcome to the IRC Server!\r\n"
             )
+            self.send_message(f":server 005 {self.nickname} MONITOR={MONITOR_LIMIT} SILENCE={SILENCE_LIMIT} :are supported by this server\r\n")
+            self.server.presence.went_online(self)
         else:
             logging.warning(f"Nickname {self.nickname} is already in the registered users set!")
 
@@ -285,6 +530,8 @@ class ClientRegistration:
 
 
 class ClientMessaging:
+    __slots__ = ()
+
     # Handle private messages, determining whether they're meant for a channel or a specific user.
     def handle_private_messages(self, message):
         parts = message.split(" ", 2)
@@ -305,14 +552,18 @@ class ClientMessaging:
     def _handle_message(self, target, message_content, is_channel=True):
         """Utility function to handle user and channel messages."""
         if is_channel:
-            if target not in self.channels:
+            channel = self.server.channels.get(target)
+            if channel is None:
                 self.send_message(f":server 403 {self.nickname} {target} :No such channel or not a member\r\n")
                 return
+            if not channel.can_send(self):
+                self.send_message(f":server 404 {self.nickname} {target} :Cannot send to channel\r\n")
+                return
         
             message = f":{self.nickname} PRIVMSG {target} :{message_content}\r\n"
-            for client in self.channels[target].clients:
-                if client != self:
-                    client.send_message(message)
+            self.server.log_channel(target, message[:-2])
+            # Members who SILENCE the sender are skipped by the delivery worker
+            self.deliver_to_channel(target, channel, message, exclude=self, silence=True)
         else:
             if self.nickname == target:
                 self.send_message(f":server 404 {self.nickname} {target} :Cannot send message to oneself\r\n")
@@ -320,11 +571,61 @@ class ClientMessaging:
 
             target_client = self._find_client_by_nickname(target)
             if target_client:
+                # Silenced messages are dropped without telling the sender
+                if target_client.silence is not None and target_client.silence.matches(self.hostmask()):
+                    return
                 message = f":{self.nickname} PRIVMSG {target} :{message_content}\r\n"
+                tracer = self.server.tracer
+                trace = tracer.current() if tracer is not None else None
+                if trace is not None:
+                    tracer.fanout_begin(trace)
                 target_client.send_message(message)
+                if trace is not None:
+                    tracer.fanout_end(trace)
             else:
                 self.send_message(f":server 401 {self.nickname} {target} :No such nickname\r\n")
 
+    # Hand line for every member of channel but exclude to the server's delivery pool. The member
+    # list is copied here, so joins and parts after this call don't change who gets it.
+    def deliver_to_channel(self, ch_name, channel, line, exclude=None, silence=False):
+        self.deliver_to_members(ch_name, list(channel.clients), line, exclude, silence)
+
+    # Hand line for some of ch_name's members to the channel's delivery worker, in order with its other lines
+    def deliver_to_members(self, ch_name, members, line, exclude=None, silence=False):
+        tracer = self.server.tracer
+        trace = tracer.current() if tracer is not None else None
+        self.server.delivery.submit(ch_name, members, line, exclude, silence, trace, sender=self)
+
+    # Handles "SILENCE [+|-]<mask>[,...]", which adds or removes masks whose messages the server won't
+    # deliver to this client. Without a parameter it lists the masks.
+    def handle_silence(self, message):
+        parts = message.split()
+        if len(parts) < 2:
+            for mask, _, _ in self.silence or ():
+                self.send_message(f":server 271 {self.nickname} {self.nickname} {mask}\r\n")
+            self.send_message(f":server 272 {self.nickname} :End of Silence List\r\n")
+            return
+        for mask in parts[1].lstrip(":").split(","):
+            sign = "+"
+            if mask[:1] in "+-":
+                sign, mask = mask[0], mask[1:]
+            if not mask:
+                continue
+            if sign == "+":
+                if self.silence is None:
+                    self.silence = MaskIndex()
+                if len(self.silence) >= SILENCE_LIMIT:
+                    self.send_message(f":server 511 {self.nickname} {mask} :Your silence list is full\r\n")
+                    continue
+                changed = self.silence.add(mask, self.nickname)
+            else:
+                changed = self.silence.remove(mask) if self.silence is not None else None
+                # Most clients never silence anyone, don't keep an empty index around
+                if self.silence is not None and not len(self.silence):
+                    self.silence = None
+            if changed:
+                self.send_message(f":{self.hostmask()} SILENCE {sign}{changed}\r\n")
+
     # Find a client by their nickname from the server's list of clients.
     def _find_client_by_nickname(self, nickname):
         target_client = None
@@ -340,15 +641,18 @@ class ClientMessaging:
 
 
 class ClientCommandProcessing:
+    __slots__ = ()
+
     def process_message(self, message):
         # Initialize a flag to indicate whether the message was handled by any command
         handled = False
+        upper = message.upper()
         # Iterate over the commands and their handlers for each
-        for cmd, handler in self.commands.items():
+        for cmd, handler in self.COMMANDS.items():
             # Check if the incoming message starts with a known command
-            if message.upper().startswith(cmd):
+            if upper.startswith(cmd):
                 # Call the associated handler for the matched command
-                handler(message)
+                getattr(self, handler)(message)
                 handled = True
                 # Exit the loop since the command has been processed
                 break
@@ -360,7 +664,7 @@ class ClientCommandProcessing:
     # "CAP LS" command which requests a list of the server's capabilities
     def handle_cap_ls(self, message=None):
         # Sends a message indicating the server capabilities.
-        self.c_sock.send(b":server CAP * LS :\r\n")
+        self.send_message(":server CAP * LS :\r\n")
 
     # "NICK" command which allows clients to set or change their nickname
     def handle_nick(self, message):
@@ -380,14 +684,16 @@ class ClientCommandProcessing:
             )
             return
         
-        # Store the current nickname before changing it
+        # Store the current nickname and registration state before changing it
         old_nickname = self.nickname
+        was_registered = self.is_registered
         # If the old nickname exists and is in the list of registered users, remove it.
         if old_nickname and old_nickname in self.server.reg_users:
             self.server.reg_users.remove(old_nickname)
     
         # Update the client's nickname to the new one
         self.nickname = new_nickname
+        self._hostmask = None
 
         # If the USER command has been received but the client is not yet registered, register the client
         if self.user_received and not self.is_registered:
@@ -397,20 +703,35 @@ class ClientCommandProcessing:
             # If only the USER command has been received, log that the server is waiting for the NICK command to complete registration
             logging.info("USER command received, awaiting NICK command for registration")
 
+        # A registered client changing nickname goes offline under the old one and online under the new one
+        if was_registered and old_nickname:
+            self.server.reg_users.add(new_nickname)
+            self.server.presence.went_offline(self, old_nickname)
+            self.server.presence.went_online(self)
+
         # If the client had an old nickname, notify all other clients about the nickname change
         if old_nickname:
             notification_msg = f":{old_nickname} NICK :{new_nickname}\r\n"
-            
+
+            # Members of a shared channel get it once, through that channel's delivery worker, so it
+            # arrives after what the client sent to the channel before
+            notified = {self}
+            for ch_name, channel in self.channels.items():
+                members = [client for client in channel.clients if client not in notified]
+                if members:
+                    notified.update(members)
+                    self.deliver_to_members(ch_name, members, notification_msg)
+
             # Aquire lock for safe manipulation
             self.server.c_lock.acquire()
             try:
-                # Notify all clients except the one changing its nickname
-                for client in self.server.clients:
-                    if client != self:
-                        client.send_message(notification_msg)
+                others = [client for client in self.server.clients if client not in notified]
             finally:
-                # Ensure the lock is released after notifying all clients.
+                # Ensure the lock is released even if building the list fails.
                 self.server.c_lock.release()
+            # Notify everyone else except the one changing its nickname
+            for client in others:
+                client.send_message(notification_msg)
 
         logging.info(f"Nickname set to {self.nickname}")
 
@@ -432,6 +753,10 @@ class ClientCommandProcessing:
 
         # Flag that we've received the USER part of the registration process.
         self.user_received = True
+        parts = message.split()
+        if len(parts) > 1:
+            self.username = parts[1]
+            self._hostmask = None
 
         # If a nickname is set and client isn't registered, complete registration
         if self.nickname and not self.is_registered:
@@ -462,16 +787,17 @@ class ClientCommandProcessing:
             self.send_message(f":server 403 {self.nickname} {channel} :No such channel or not a member\r\n")
             return
 
+        # Notify the channel's members, the client included, that this client has left the channel.
+        # It goes through the channel's delivery worker, after the client's earlier lines to it.
+        part_command = f":{self.nickname} PART {channel}\r\n"
+        self.server.log_channel(channel, part_command[:-2])
+        self.deliver_to_channel(channel, self.channels[channel], part_command)
+
         # Remove the client from the specified channel's list of members
-        self.channels[channel].remove_client(self)
+        self.channels[channel].remove_client(self, notify=False)
         
         # Remove the channel from the client's list of channels
-        del self.channels[channel]
-
-        # Notify all clients that this client has left the channel
-        part_command = f":{self.nickname} PART {channel}\r\n"
-        for client in self.server.clients:
-            client.send_message(part_command)
+        self.leave_channel_entry(channel)
     
     # Handles the "CAP END" command, which indicates the end of the client's capability negotiation phase.
     # Currently, this implementation does not perform any action upon receiving this command.        
@@ -502,45 +828,57 @@ class ClientCommandProcessing:
 
     # Handles the "JOIN" command, which allows a client to join a channel
     def handle_join(self, message):
-        # Extract the channel name from the received message
-        ch_name = message.split(" ")[1].strip()
+        # Extract the channel name and optional key from the received message
+        parts = message.split()
+        ch_name = parts[1].strip()
+        key = parts[2] if len(parts) > 2 else None
 
         # Ensure the channel name starts with '#'
         if ch_name.startswith("#"):
             # Initiate the process for the client to join the specified channel
-            self.join_channel(ch_name)
+            self.join_channel(ch_name, key)
         else:
             # If the channel name doesn't start with '#', inform the client of the incorrect usage
             self.send_message(f":server 461 {ch_name} :Not enough parameters\r\n")
 
 
     # Allows the client to join a specified channel or creates it if it doesn't exist
-    def join_channel(self, ch_name):
+    def join_channel(self, ch_name, key=None):
         # Fetch the channel object, creating it if it doesn't already exist
         channel = self.server.get_or_create_channel(ch_name)
 
         # If the client is not already in the specified channel:
         if ch_name not in self.channels:
+            # Refuse the join if the key, user limit or ban list says so
+            error = channel.join_error(self, key)
+            if error:
+                self.send_message(f":server {error[0]} {self.nickname} {ch_name} :{error[1]}\r\n")
+                return
+            # Whoever creates the channel is its first operator
+            if not channel.clients:
+                channel.ops.add(self)
             # Add the client to the channel
             channel.add_client(self)
             # Update the client's list of channels
-            self.channels[ch_name] = channel
+            self.add_channel_entry(ch_name, channel)
 
             # Construct a message indicating that the client has joined the channel.
             join_message = f":{self.nickname} JOIN :{ch_name}\r\n"
+            self.server.log_channel(ch_name, join_message[:-2])
 
-            # Notify all other clients in the channel about the new joiner
-            for client in channel.clients:
-                if client != self:
-                    client.send_message(join_message)
+            # The joiner gets its JOIN straight away, ahead of any replies about the channel; the other
+            # members get it through the channel's delivery worker
+            self.send_message(join_message)
+            self.deliver_to_channel(ch_name, channel, join_message, exclude=self)
 
-            # Gather a list of all current nicknames in the channel
-            user_nicknames = set(client.nickname for client in channel.clients)
-            users_list = " ".join(user_nicknames)
+            # Gather a list of all current nicknames in the channel, in join order so it is the same
+            # from run to run (a set's order changes with hash randomization, which upsets replay.py diffs)
+            users_list = " ".join(client.nickname for client in channel.clients)
         
             # Notify all clients in the channel about the current list of users
-            notice_message = f"Users in {ch_name}: {users_list}"
-            channel.send_notice("server", notice_message)
+            notice_message = f":server NOTICE {ch_name} :Users in {ch_name}: {users_list}\r\n"
+            self.send_message(notice_message)
+            self.deliver_to_channel(ch_name, channel, notice_message, exclude=self)
 
             
     # Handles the "PING" command, which checks connectivity between clients
@@ -559,18 +897,19 @@ class ClientCommandProcessing:
         parts = message.split(" ", 1)
     
         if len(parts) > 1:
-            quit_msg = parts[1]
+            # The reason is a trailing parameter, its ":" isn't part of it
+            quit_msg = parts[1][1:] if parts[1].startswith(":") else parts[1]
         else:
             quit_msg = f"{self.nickname} has quit"
 
         # Notify all other clients in the channel that user quit
+        quit_line = f":{self.nickname} QUIT :{quit_msg}\r\n"
         for ch_name, channel in self.channels.items():
-            for client in self.server.clients:
-                if ch_name in client.channels and client != self:
-                    client.send_message(f":{self.nickname} QUIT :{quit_msg}\r\n")
+            self.deliver_to_channel(ch_name, channel, quit_line, exclude=self)
+            channel.remove_client(self, notify=False)
 
         # Clear the client's list of channels
-        self.channels.clear()
+        self._channels = None
 
         # Send a quit notification to the client itself
         self.send_message(f":{self.nickname} QUIT :{quit_msg}\r\n")
@@ -629,12 +968,22 @@ class ClientCommandProcessing:
         # Separate the target from the remaining mode parameters
         target, *remaining_parts = parts[1:]
 
+        # Channel modes are handled separately
+        if target.startswith("#"):
+            self.handle_channel_mode(target, remaining_parts)
+            return
+
         # Check if the target of the MODE command is the client's nickname
         if target == self.nickname:
             # Determine the desired mode, or fetch the current mode if none is provided
             user_mode = remaining_parts[0] if remaining_parts else self.get_user_mode()
             message = None
 
+            # Operator status is only granted by OPER
+            if user_mode == "+o" and "o" not in self.user_mode:
+                self.send_message(f":server 481 {self.nickname} :Permission Denied- Use OPER to become an IRC operator\r\n")
+                return
+
             # If a mode is provided:
             if remaining_parts:
                 # Set the provided mode for the client
@@ -653,12 +1002,41 @@ class ClientCommandProcessing:
             self.send_message(message)
 
 
-    def handle_kick(self, message=None):
-        self.send_message(":server 502 :KICK command is not supported\r\n")
+    # Handles "OPER <name> <password>", which makes the client an IRC operator if the server knows the credentials
+    def handle_oper(self, message):
+        parts = message.split()
+        if len(parts) < 3:
+            self.send_message(f":server 461 {self.nickname} OPER :Not enough parameters\r\n")
+            return
+        password = self.server.operators.get(parts[1])
+        if password is None or not hmac.compare_digest(password.encode(), parts[2].encode()):
+            logging.warning(f"Failed OPER attempt by {self.nickname}")
+            self.send_message(f":server 464 {self.nickname} :Password incorrect\r\n")
+            return
+        self.user_mode = "o"
+        self.send_message(f":server 381 {self.nickname} :You are now an IRC operator\r\n")
 
     def handle_motd(self, message=None):
         self.send_message(":server 502 :MOTD command is not supported\r\n")
 
+    # Handles the "PROFILE [seconds] [nomem]" operator command, which profiles the server for a bounded window.
+    def handle_profile(self, message):
+        if "o" not in self.user_mode:
+            self.send_message(f":server 481 {self.nickname} :Permission Denied- You're not an IRC operator\r\n")
+            return
+        parts = message.split()
+        try:
+            duration = int(parts[1]) if len(parts) > 1 else DEFAULT_DURATION
+        except ValueError:
+            self.send_message(f":server 461 {self.nickname} PROFILE :Usage PROFILE [seconds] [nomem]\r\n")
+            return
+        memory = not (len(parts) > 2 and parts[2].lower() == "nomem")
+        prefix = self.server.profiler.start(duration, memory=memory)
+        if prefix is None:
+            self.send_message(f":server NOTICE {self.nickname} :A profiling session is already running\r\n")
+        else:
+            self.send_message(f":server NOTICE {self.nickname} :Profiling started, results in {prefix}.*\r\n")
+
     # Handles the "LIST" command which provides a list of channels and their topics.
     # If there are no channels, an appropriate message is sent.
     def handle_list(self, message=None):
@@ -682,39 +1060,320 @@ class ClientCommandProcessing:
         self.send_message(f":server 255 {self.nickname} :I have {total_users} clients and 1 servers\r\n")
 
 
+class ClientChannelModeration:
+    __slots__ = ()
+
+    # Handles channel MODE queries and changes: MODE <channel> [<modes> [<params>...]]
+    def handle_channel_mode(self, ch_name, args):
+        channel = self.server.channels.get(ch_name)
+        if channel is None:
+            self.send_message(f":server 403 {self.nickname} {ch_name} :No such channel\r\n")
+            return
+
+        # Without a mode string, report the current modes. The key is only shown to members.
+        if not args:
+            modes, params = channel.mode_string(show_key=ch_name in self.channels)
+            self.send_message(f":server 324 {self.nickname} {ch_name} {modes}{' ' + ' '.join(params) if params else ''}\r\n")
+            return
+
+        mode_chars, params = args[0], list(args[1:])
+        is_op = self in channel.ops
+        sign = "+"
+        applied = []
+        for char in mode_chars:
+            if char in "+-":
+                sign = char
+                continue
+            if char in LIST_MODES:
+                # A list mode without a mask lists the entries
+                if not params:
+                    self.send_mode_list(channel, char)
+                    continue
+                if not self.require_op(channel, is_op):
+                    return
+                mask = params.pop(0)
+                entries = getattr(channel, LIST_MODES[char][0])
+                if sign == "+":
+                    if len(entries) >= MAX_LIST_ENTRIES:
+                        self.send_message(f":server 478 {self.nickname} {ch_name} {mask} :Channel list is full\r\n")
+                        continue
+                    changed = entries.add(mask, self.nickname)
+                else:
+                    changed = entries.remove(mask)
+                if changed:
+                    applied.append((sign, char, changed))
+            elif char in PARAM_MODES:
+                if not self.require_op(channel, is_op):
+                    return
+                # "-l" and "-k" don't need a parameter
+                needs_param = sign == "+" or char in "ov"
+                if needs_param and not params:
+                    self.send_message(f":server 461 {self.nickname} MODE :Not enough parameters\r\n")
+                    continue
+                param = params.pop(0) if needs_param or (char == "k" and params) else None
+                change = self.apply_param_mode(channel, sign, char, param)
+                if change:
+                    applied.append(change)
+            elif char in FLAG_MODES:
+                if not self.require_op(channel, is_op):
+                    return
+                if sign == "+" and char not in channel.modes:
+                    channel.modes.add(char)
+                    applied.append((sign, char, None))
+                elif sign == "-" and char in channel.modes:
+                    channel.modes.discard(char)
+                    applied.append((sign, char, None))
+            else:
+                self.send_message(f":server 472 {self.nickname} {char} :is unknown mode char to me for {ch_name}\r\n")
+
+        if applied:
+            self.deliver_to_channel(ch_name, channel, f":{self.nickname} MODE {ch_name} {format_mode_changes(applied)}\r\n")
+
+    # Apply one of k, l, o, v. Returns the (sign, char, param) to announce, or None.
+    def apply_param_mode(self, channel, sign, char, param):
+        if char in "ov":
+            member = channel.find_member(param)
+            if member is None:
+                self.send_message(f":server 441 {self.nickname} {param} {channel.name} :They aren't on that channel\r\n")
+                return None
+            members = channel.ops if char == "o" else channel.voiced
+            if sign == "+":
+                members.add(member)
+            else:
+                members.discard(member)
+            return (sign, char, member.nickname)
+        if char == "k":
+            if sign == "+":
+                channel.key = param
+                channel.modes.add("k")
+                return (sign, char, param)
+            channel.key = None
+            channel.modes.discard("k")
+            return (sign, char, "*")
+        # char == "l"
+        if sign == "+":
+            try:
+                limit = int(param)
+            except ValueError:
+                return None
+            if limit <= 0:
+                return None
+            channel.limit = limit
+            channel.modes.add("l")
+            return (sign, char, str(limit))
+        channel.limit = None
+        channel.modes.discard("l")
+        return (sign, char, None)
+
+    def require_op(self, channel, is_op):
+        if not is_op:
+            self.send_message(f":server 482 {self.nickname} {channel.name} :You're not channel operator\r\n")
+        return is_op
+
+    def send_mode_list(self, channel, char):
+        attr, item_numeric, end_numeric, end_text = LIST_MODES[char]
+        for mask, set_by, set_at in getattr(channel, attr):
+            self.send_message(f":server {item_numeric} {self.nickname} {channel.name} {mask} {set_by} {set_at}\r\n")
+        self.send_message(f":server {end_numeric} {self.nickname} {channel.name} :{end_text}\r\n")
+
+    # Handles the "KICK <channel> <nick> [:reason]" command, which lets channel operators remove a member.
+    def handle_kick(self, message):
+        parts = message.split(" ", 3)
+        if len(parts) < 3:
+            self.send_message(f":server 461 {self.nickname} KICK :Not enough parameters\r\n")
+            return
+
+        ch_name, target_nick = parts[1], parts[2]
+        reason = parts[3][1:] if len(parts) > 3 and parts[3].startswith(":") else (parts[3] if len(parts) > 3 else self.nickname)
+
+        channel = self.server.channels.get(ch_name)
+        if channel is None:
+            self.send_message(f":server 403 {self.nickname} {ch_name} :No such channel\r\n")
+            return
+        if ch_name not in self.channels:
+            self.send_message(f":server 442 {self.nickname} {ch_name} :You're not on that channel\r\n")
+            return
+        if not self.require_op(channel, self in channel.ops):
+            return
+        target = channel.find_member(target_nick)
+        if target is None:
+            self.send_message(f":server 441 {self.nickname} {target_nick} {ch_name} :They aren't on that channel\r\n")
+            return
+
+        # Everyone in the channel, including the kicked user, sees the KICK
+        kick_message = f":{self.nickname} KICK {ch_name} {target.nickname} :{reason}"
+        self.server.log_channel(ch_name, kick_message)
+        self.deliver_to_channel(ch_name, channel, kick_message + "\r\n")
+        channel.remove_client(target, notify=False)
+        target.leave_channel_entry(ch_name)
+
+
+class ClientPresence:
+    __slots__ = ()
+
+    # Handles "ISON <nick> [<nick>...]", replying with the nicknames that are online.
+    def handle_ison(self, message):
+        nicknames = message.split()[1:]
+        if not nicknames:
+            self.send_message(f":server 461 {self.nickname} ISON :Not enough parameters\r\n")
+            return
+        # The trailing parameter may hold several space separated nicknames
+        nicknames = " ".join(nicknames).lstrip(":").split()
+        online = [client.nickname for client in map(self.server.presence.lookup, nicknames) if client is not None]
+        self.send_message(f":server 303 {self.nickname} :{' '.join(online)}\r\n")
+
+    # Handles "MONITOR +|- <nick>[,<nick>...]" and "MONITOR C|L|S" (IRCv3 MONITOR)
+    def handle_monitor(self, message):
+        parts = message.split(" ", 2)
+        if len(parts) < 2:
+            self.send_message(f":server 461 {self.nickname} MONITOR :Not enough parameters\r\n")
+            return
+        action = parts[1].upper()
+        targets = [nick for nick in parts[2].lstrip(":").split(",") if nick] if len(parts) > 2 else []
+        presence = self.server.presence
+
+        if action == "+":
+            added, rejected = presence.watch(self, targets, MONITOR_LIMIT)
+            if rejected:
+                self.send_message(f":server 734 {self.nickname} {MONITOR_LIMIT} {','.join(rejected)} :Monitor list is full\r\n")
+            self.send_monitor_status(added)
+        elif action == "-":
+            presence.unwatch(self, targets)
+        elif action == "C":
+            presence.unwatch_all(self)
+        elif action == "L":
+            watched = presence.watched_by(self)
+            # Keep replies well under the 512 byte line limit
+            for i in range(0, len(watched), 20):
+                self.send_message(f":server 732 {self.nickname} :{','.join(watched[i:i + 20])}\r\n")
+            self.send_message(f":server 733 {self.nickname} :End of MONITOR list\r\n")
+        elif action == "S":
+            self.send_monitor_status(presence.watched_by(self))
+        else:
+            self.send_message(f":server 421 {self.nickname} MONITOR :Unknown MONITOR action\r\n")
+
+    # RPL_MONONLINE / RPL_MONOFFLINE for the given nicknames
+    def send_monitor_status(self, nicknames):
+        online, offline = [], []
+        for nick in nicknames:
+            client = self.server.presence.lookup(nick)
+            if client is not None:
+                online.append(client.hostmask())
+            else:
+                offline.append(nick)
+        for i in range(0, len(online), 10):
+            self.send_message(f":server 730 {self.nickname} :{','.join(online[i:i + 10])}\r\n")
+        for i in range(0, len(offline), 20):
+            self.send_message(f":server 731 {self.nickname} :{','.join(offline[i:i + 20])}\r\n")
+
+
+# "+ov-b alice bob *!*@host" from [(sign, char, param), ...]
+def format_mode_changes(changes):
+    modes = ""
+    params = []
+    sign = None
+    for change_sign, char, param in changes:
+        if change_sign != sign:
+            modes += change_sign
+            sign = change_sign
+        modes += char
+        if param is not None:
+            params.append(param)
+    return " ".join([modes] + params)
+
+
 class IRCClient(
-    ClientConnection, ClientRegistration, ClientMessaging, ClientCommandProcessing
+    ClientConnection, ClientRegistration, ClientMessaging, ClientCommandProcessing, ClientChannelModeration,
+    ClientPresence
 ):
     TIMEOUT = 500
+    # Default inbound limit in lines per second, 0 for none. Changeable from the admin socket.
+    RATE_LIMIT = 0.0
+    RATE_BURST = 10
+
+    # Fixed attribute layout instead of a per-instance __dict__, we may hold 100k of these
+    __slots__ = (
+        "c_sock", "server", "nickname", "user_mode", "_channels",
+        "user_received", "buffer", "is_registered", "disconnected", "conn_id",
+        "username", "host", "_hostmask", "monitoring",
+        "last_activity", "throttle", "killed", "inbox", "scheduled", "silence",
+        "send_lock", "outbuf", "deliveries", "parked",
+    )
+
+    # Command prefix -> handler method name, shared by all clients
+    COMMANDS = {
+        "CAP LS": "handle_cap_ls",
+        "NICK": "handle_nick",
+        "USER": "handle_user",
+        "CAP END": "handle_cap_end",
+        "JOIN": "handle_join",
+        "PING": "handle_ping",
+        "PRIVMSG": "handle_private_messages",
+        "QUIT": "handle_quit",
+        "WHO": "handle_who",
+        "MODE": "handle_mode",
+        "KICK": "handle_kick",
+        "MOTD": "handle_motd",
+        "PART": "handle_part",
+        "LIST": "handle_list",
+        "LUSERS": "handle_lusers",
+        "PROFILE": "handle_profile",
+        "MONITOR": "handle_monitor",
+        "ISON": "handle_ison",
+        "SILENCE": "handle_silence",
+        "OPER": "handle_oper"
+    }
 
     def __init__(self, c_sock, server):
         self.c_sock = c_sock
         self.server = server
         self.nickname = None
         self.user_mode = ""
-        self.channels = {}
+        # Allocated on the first JOIN and dropped again when the client leaves its last channel
+        self._channels = None
         self.user_received = False
+        # "" is a shared singleton, partial lines only cost memory while they are pending
         self.buffer = ""
         self.is_registered = False
         self.disconnected = False
-
-        self.commands = {
-            "CAP LS": self.handle_cap_ls,
-            "NICK": self.handle_nick,
-            "USER": self.handle_user,
-            "CAP END": self.handle_cap_end,
-            "JOIN": self.handle_join,
-            "PING": self.handle_ping,
-            "PRIVMSG": self.handle_private_messages,
-            "QUIT": self.handle_quit,
-            "WHO": self.handle_who,
-            "MODE": self.handle_mode,
-            "KICK": self.handle_kick,
-            "MOTD": self.handle_motd,
-            "PART": self.handle_part,
-            "LIST": self.handle_list,
-            "LUSERS": self.handle_lusers
-        }
+        # Connection id in the traffic capture, if one is running
+        self.conn_id = 0
+        self.username = None
+        self.host = None
+        self._hostmask = None
+        # Case-folded nicknames this client MONITORs, allocated on first use
+        self.monitoring = None
+        # Admin socket state: when we last heard from the client, its inbound TokenBucket and kill reason
+        self.last_activity = time.monotonic()
+        self.throttle = None
+        self.killed = None
+        # Lines waiting for the scheduler (allocated while there are any) and whether it has this client queued
+        self.inbox = None
+        self.scheduled = False
+        # Fan-outs this client caused that wait in the delivery pool, and whether the scheduler parked it for them
+        self.deliveries = 0
+        self.parked = False
+        # MaskIndex of SILENCEd senders, None while the list is empty
+        self.silence = None
+        # Output the socket couldn't take yet (allocated while there is any), see write()
+        self.send_lock = threading.Lock()
+        self.outbuf = None
+
+    # Channels this client is in, by name. Read-only, use add_channel_entry/leave_channel_entry to change it.
+    @property
+    def channels(self):
+        return self._channels if self._channels is not None else NO_CHANNELS
+
+    def add_channel_entry(self, ch_name, channel):
+        if self._channels is None:
+            self._channels = {}
+        self._channels[ch_name] = channel
+
+    def leave_channel_entry(self, ch_name):
+        if self._channels is not None:
+            self._channels.pop(ch_name, None)
+            if not self._channels:
+                self._channels = None
 
     def set_user_mode(self, new_mode):
         if new_mode == "+o":
@@ -725,35 +1384,184 @@ class IRCClient(
     def get_user_mode(self):
         return self.user_mode
 
+    # nick!user@host, used to match ban and exception masks
+    def hostmask(self):
+        if self._hostmask is None:
+            if self.host is None:
+                try:
+                    self.host = self.c_sock.getpeername()[0]
+                except (socket.error, AttributeError):
+                    self.host = "unknown"
+            self._hostmask = f"{self.nickname}!{self.username or self.nickname}@{self.host}"
+        return self._hostmask
+
 
 class Channel:
+    __slots__ = ("name", "clients", "modes", "key", "limit", "bans", "excepts", "ops", "voiced")
+
     def __init__(self, name):
         self.name = name
         self.clients = []
-
+        self.modes = set(DEFAULT_CHANNEL_MODES)
+        self.key = None
+        self.limit = None
+        self.bans = MaskIndex()
+        self.excepts = MaskIndex()
+        self.ops = set()
+        self.voiced = set()
+
+    # The JOIN itself is sent by the caller
     def add_client(self, client):
         if client not in self.clients:
             self.clients.append(client)
-            client.send_message(f":{client.nickname} JOIN :{self.name}\r\n")
 
-    def remove_client(self, client):
+    def remove_client(self, client, notify=True):
         if client in self.clients:
             self.clients.remove(client)
-            client.send_message(f":{client.nickname} PART :{self.name}\r\n")
+            self.ops.discard(client)
+            self.voiced.discard(client)
+            if notify:
+                client.send_message(f":{client.nickname} PART :{self.name}\r\n")
 
-    def broadcast(self, message, origin_client):
+    def find_member(self, nickname):
         for client in self.clients:
-            if client != origin_client:
-                client.send_message(
-                    f":{origin_client.nickname} PRIVMSG {self.name} :{message}\r\n"
-                )
+            if client.nickname == nickname:
+                return client
+        return None
 
-    def send_notice(self, sender, message):
-        notice = f":{sender} NOTICE {self.name} :{message}\r\n"
-        for client in self.clients:
-            client.send_message(notice)
+    def is_banned(self, client):
+        if not self.bans.entries:
+            return False
+        hostmask = client.hostmask()
+        return self.bans.matches(hostmask) and not self.excepts.matches(hostmask)
+
+    # (numeric, text) explaining why client can't join, or None if it can
+    def join_error(self, client, key=None):
+        if "k" in self.modes and key != self.key:
+            return ("475", "Cannot join channel (+k)")
+        if "l" in self.modes and len(self.clients) >= self.limit:
+            return ("471", "Cannot join channel (+l)")
+        if self.is_banned(client):
+            return ("474", "Cannot join channel (+b)")
+        return None
+
+    # Outsiders need -n, and under +m or a ban only operators and voiced users may speak
+    def can_send(self, client):
+        if self.name not in client.channels:
+            if "n" in self.modes:
+                return False
+        elif client in self.ops or client in self.voiced:
+            return True
+        if "m" in self.modes:
+            return False
+        return not self.is_banned(client)
+
+    # "+nkl", ["key", "10"]
+    def mode_string(self, show_key=True):
+        modes = "+" + "".join(sorted(self.modes))
+        params = []
+        if "k" in self.modes:
+            params.append(self.key if show_key else "*")
+        if "l" in self.modes:
+            params.append(str(self.limit))
+        return modes, params
+
+
+class PresenceIndex:
+    # Online users and the reverse MONITOR index (watched nickname -> watching clients), both keyed
+    # by case-folded nickname, so a presence change only touches the clients watching that nickname.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.online = {}
+        self.watchers = {}
+
+    def lookup(self, nickname):
+        return self.online.get(irc_lower(nickname))
+
+    # Returns (nicknames added, nicknames rejected because the client's list is full)
+    def watch(self, client, nicknames, limit):
+        added, rejected = [], []
+        with self.lock:
+            if client.monitoring is None:
+                client.monitoring = {}
+            for nick in nicknames:
+                key = irc_lower(nick)
+                if key in client.monitoring:
+                    continue
+                if len(client.monitoring) >= limit:
+                    rejected.append(nick)
+                    continue
+                client.monitoring[key] = nick
+                self.watchers.setdefault(key, set()).add(client)
+                added.append(nick)
+        return added, rejected
+
+    def unwatch(self, client, nicknames):
+        with self.lock:
+            for nick in nicknames:
+                self._unwatch(client, irc_lower(nick))
+
+    def unwatch_all(self, client):
+        if not client.monitoring:
+            return
+        with self.lock:
+            for key in list(client.monitoring):
+                self._unwatch(client, key)
+            client.monitoring = None
+
+    def _unwatch(self, client, key):
+        if client.monitoring and client.monitoring.pop(key, None) is not None:
+            watchers = self.watchers.get(key)
+            if watchers is not None:
+                watchers.discard(client)
+                if not watchers:
+                    del self.watchers[key]
+
+    def watched_by(self, client):
+        with self.lock:
+            return list(client.monitoring.values()) if client.monitoring else []
+
+    def went_online(self, client):
+        key = irc_lower(client.nickname)
+        with self.lock:
+            self.online[key] = client
+            watchers = list(self.watchers.get(key, ()))
+        for watcher in watchers:
+            watcher.send_message(f":server 730 {watcher.nickname} :{client.hostmask()}\r\n")
+
+    def went_offline(self, client, nickname):
+        key = irc_lower(nickname)
+        with self.lock:
+            # Only the client that holds the nickname can take it offline
+            if self.online.get(key) is not client:
+                return
+            del self.online[key]
+            watchers = list(self.watchers.get(key, ()))
+        for watcher in watchers:
+            if watcher is not client:
+                watcher.send_message(f":server 731 {watcher.nickname} :{nickname}\r\n")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IRC server")
+    parser.add_argument("--capture", metavar="PATH", help="Record all client traffic to PATH for replay.py")
+    parser.add_argument("--chanlog", metavar="DIR", help="Keep a queryable log of channel messages under DIR, see chanlog.py")
+    parser.add_argument("--trace", metavar="RATE", type=float, nargs="?", const=DEFAULT_SAMPLE_RATE,
+                        help=f"Trace delivery latency of this fraction of messages (default {DEFAULT_SAMPLE_RATE})")
+    parser.add_argument("--opers", metavar="PATH", help="OPER credentials, one \"name password\" per line")
+    parser.add_argument("--admin-socket", metavar="PATH", help="Serve the admin commands of admin.py on a Unix socket at PATH")
+    args = parser.parse_args()
     server = IRCServer()
+    if args.opers:
+        server.load_operators(args.opers)
+    if args.capture:
+        server.capture = TrafficCapture(args.capture)
+    if args.chanlog:
+        server.chanlog = ChannelLog(args.chanlog)
+        server.chanlog.start()
+    if args.trace:
+        server.tracer = Tracer(args.trace)
+    if args.admin_socket:
+        server.admin = AdminServer(server, args.admin_socket)
+        server.admin.start()
     server.start()
@@ -0,0 +1,217 @@
+import json
+import math
+import random
+import threading
+import time
+
+# Histogram bucket upper bounds in microseconds: 1us, 2us, 4us ... about 67s
+BUCKET_BOUNDS = [1 << i for i in range(27)]
+# Stages of a traced message, in the order they happen
+STAGES = (
+    "queue",       # received -> picked up by a scheduler worker
+    "dispatch",    # picked up -> fan-out starts or is handed to the delivery pool (parsing, checks, lock waits)
+    "pool_wait",   # handed to the delivery pool -> a delivery worker starts on it
+    "fanout",      # first -> last recipient's send of one fan-out
+    "write",       # one recipient's socket send() call
+    "send_delay",  # fan-out start -> one recipient's bytes handed to its socket
+    "total",       # received -> last recipient's send, or -> handled if nothing was sent
+)
+DEFAULT_SAMPLE_RATE = 0.01
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        # Bucket i holds values up to 2**i us
+        self.counts[min(max(math.ceil(us) - 1, 0).bit_length(), len(BUCKET_BOUNDS))] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Upper bound of the bucket holding the p-th value, in milliseconds, capped at the largest value seen
+    def percentile(self, p):
+        if not self.count:
+            return None
+        largest = round(self.max * 1000, 3)
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKET_BOUNDS[i] / 1000, largest) if i < len(BUCKET_BOUNDS) else largest
+        return largest
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else None,
+            "p50_ms": self.percentile(0.50),
+            "p90_ms": self.percentile(0.90),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max * 1000, 3),
+            "buckets_us": [[BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else "+Inf", n] for i, n in enumerate(self.counts) if n],
+        }
+
+
+class Trace:
+    # One sampled line. Its fan-outs may run on other threads (see fanout.py), so the parts they
+    # share are updated under the tracer's lock.
+    __slots__ = ("tracer", "received", "dispatched", "dispatch_recorded", "handoffs", "ended", "last_write", "recipients")
+
+    def __init__(self, tracer, received):
+        self.tracer = tracer
+        self.received = received
+        self.dispatched = None
+        self.dispatch_recorded = False
+        # Fan-outs handed to the delivery pool and not finished yet
+        self.handoffs = 0
+        self.ended = False
+        self.last_write = None
+        self.recipients = 0
+
+
+class Tracer:
+    # Samples a fraction of received lines and times them through the server: waiting for the
+    # scheduler, dispatch, the delivery pool, fan-out and every recipient's socket write. Timings go
+    # into per-stage log2 histograms. Unsampled lines cost one random() call at ingress and one
+    # thread-local lookup per send.
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        # Per thread: the trace being worked on and when this thread's fan-out of it started
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.sampled = 0
+        self.started = time.time()
+
+    # A Trace for a line received now, or None if it isn't sampled
+    def ingress(self, received=None):
+        if random.random() >= self.sample_rate:
+            return None
+        return Trace(self, received if received is not None else time.perf_counter())
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].add(seconds)
+
+    # The trace of the line the calling thread is processing, if it is sampled
+    def current(self):
+        return getattr(self.local, "trace", None)
+
+    # A scheduler worker starts processing the line
+    def begin(self, trace):
+        trace.dispatched = time.perf_counter()
+        self.local.trace = trace
+        self.record("queue", trace.dispatched - trace.received)
+
+    # The worker is done with the line. Fan-outs still in the delivery pool finish the trace later.
+    def end(self, trace):
+        self.local.trace = None
+        now = time.perf_counter()
+        with self.lock:
+            trace.ended = True
+            self._dispatch_done(trace, now)
+            if not trace.handoffs:
+                self.histograms["total"].add((trace.last_write or now) - trace.received)
+            self.sampled += 1
+
+    def _dispatch_done(self, trace, now):
+        if not trace.dispatch_recorded:
+            trace.dispatch_recorded = True
+            self.histograms["dispatch"].add(now - trace.dispatched)
+
+    # Fan-out done inline on the processing thread
+    def fanout_begin(self, trace):
+        now = self.local.fanout_start = time.perf_counter()
+        with self.lock:
+            self._dispatch_done(trace, now)
+
+    def fanout_end(self, trace):
+        self.record("fanout", time.perf_counter() - self.local.fanout_start)
+        self.local.fanout_start = None
+
+    # A fan-out is handed to the delivery pool. Returns the time it was queued.
+    def handoff(self, trace):
+        now = time.perf_counter()
+        with self.lock:
+            self._dispatch_done(trace, now)
+            trace.handoffs += 1
+        return now
+
+    # A delivery worker starts and finishes a fan-out handed off at queued_at. When the pool isn't
+    # started the fan-out runs on the processing thread itself, so the thread's own trace state is
+    # returned by delivery_begin and put back by delivery_end.
+    def delivery_begin(self, trace, queued_at):
+        saved = (getattr(self.local, "trace", None), getattr(self.local, "fanout_start", None))
+        now = self.local.fanout_start = time.perf_counter()
+        self.local.trace = trace
+        self.record("pool_wait", now - queued_at)
+        return saved
+
+    def delivery_end(self, trace, saved):
+        now = time.perf_counter()
+        with self.lock:
+            self.histograms["fanout"].add(now - self.local.fanout_start)
+            trace.handoffs -= 1
+            if trace.ended and not trace.handoffs:
+                self.histograms["total"].add((trace.last_write or now) - trace.received)
+        self.local.trace, self.local.fanout_start = saved
+
+    # A recipient's send() that started at `started` just returned
+    def record_send(self, trace, started):
+        fanout_start = getattr(self.local, "fanout_start", None)
+        if fanout_start is None:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            if trace.last_write is None or now > trace.last_write:
+                trace.last_write = now
+            trace.recipients += 1
+            self.histograms["write"].add(now - started)
+            self.histograms["send_delay"].add(now - fanout_start)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {stage: Histogram() for stage in STAGES}
+            self.sampled = 0
+            self.started = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "since": self.started,
+                "sampled": self.sampled,
+                "stages": {stage: histogram.snapshot() for stage, histogram in self.histograms.items()},
+            }
+
+    # Prometheus text exposition of the histograms, bucket bounds in seconds
+    def prometheus(self):
+        lines = ["# TYPE irc_delivery_seconds histogram"]
+        with self.lock:
+            for stage, histogram in self.histograms.items():
+                cumulative = 0
+                for i, n in enumerate(histogram.counts):
+                    cumulative += n
+                    bound = f"{BUCKET_BOUNDS[i] / 1e6:g}" if i < len(BUCKET_BOUNDS) else "+Inf"
+                    lines.append(f'irc_delivery_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'irc_delivery_seconds_sum{{stage="{stage}"}} {histogram.total}')
+                lines.append(f'irc_delivery_seconds_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    # Write the histograms to path as JSON, or in Prometheus text format if the path ends in .prom
+    def export(self, path):
+        with open(path, "w") as out:
+            if path.endswith(".prom"):
+                out.write(self.prometheus())
+            else:
+                json.dump(self.snapshot(), out, indent=2)